@@ -1,35 +1,118 @@
 import asyncio
+import hashlib
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from configparser import SectionProxy
 from functools import partial
 from pathlib import Path
 
-import aiohttp
 import requests
 
-from common import API, APIEnum, RequestError
-from utils import ThreadDownload
+from common import API, APIEnum, JSONStream, RequestError, TimeOutError, loads
+from tracing import tracer
+from transport import Transport, default_transport
+from utils import BufferQueue, ThreadDownload, read_into
 
-BaiduHost = partial(API, host='https://pan.baidu.com')
+BAIDU_HOST = 'https://pan.baidu.com'
+BAIDU_OPENAPI_HOST = 'https://openapi.baidu.com'
+BAIDU_PCS_HOST = 'https://d.pcs.baidu.com'
+BaiduHost = partial(API, host=BAIDU_HOST)
+STREAM_CHUNK = 65536
+FILEMETA_BATCH = 100
+DLINK_TTL = 25200
+UPLOAD_BLOCK = 4194304
+RELAY_CHUNK = 10485760
+SLICE_MD5_SIZE = 262144
+TOKEN_RETRY = 5
+TOKEN_WAIT = 3
 
 
 class _BaiduURL(APIEnum):
     refresh_token = API('refresh_token',
                         '{host}/oauth/2.0/token?grant_type=refresh_token&openapi=xpansdk',
-                        host='https://openapi.baidu.com')
+                        host=BAIDU_OPENAPI_HOST)
     listall = BaiduHost('listall', '{host}/rest/2.0/xpan/multimedia?method=listall')
     filemeta = BaiduHost('filemeta', '{host}/rest/2.0/xpan/multimedia?method=filemetas&openapi=xpansdk')
     pre_create = BaiduHost('pre_create', '{host}/rest/2.0/xpan/file?method=precreate&openapi=xpansdk', method='post')
-    upload = BaiduHost('upload', '{host}/rest/2.0/pcs/superfile2?method=upload&openapi=xpansdk', method='post')
+    upload = API('upload',
+                 '{host}/rest/2.0/pcs/superfile2?method=upload&openapi=xpansdk',
+                 host=BAIDU_PCS_HOST,
+                 method='post')
     create = BaiduHost('create', '{host}/rest/2.0/xpan/file?method=create&openapi=xpansdk', method='post')
     search = BaiduHost('search', '{host}/rest/2.0/xpan/file?method=search&openapi=xpansdk')
 
 
-class BaiduAPI:
+class FileMetaResolver:
 
-    def __init__(self, config: SectionProxy, update_token=None):
-        self._session = requests.Session()
+    def __init__(self, api: 'BaiduAPI', ttl: float = DLINK_TTL, batch: int = FILEMETA_BATCH):
+        self.api = api
+        self.ttl = ttl
+        self.batch = batch
+        self._metas = {}
+        self._pending = []
+
+    def _fresh(self, fs_id: int) -> bool:
+        meta = self._metas.get(fs_id)
+        return meta is not None and meta[0] > time.time()
+
+    def prefetch(self, fs_ids):
+        pending = set(self._pending)
+        for fs_id in fs_ids:
+            if fs_id not in pending and not self._fresh(fs_id):
+                self._pending.append(fs_id)
+                pending.add(fs_id)
+
+    def next_batch(self, fs_id: int) -> list:
+        fs_ids = [fs_id]
+        while self._pending and len(fs_ids) < self.batch:
+            i = self._pending.pop(0)
+            if i != fs_id and not self._fresh(i):
+                fs_ids.append(i)
+        return fs_ids
+
+    def update(self, metas: list):
+        expires_at = time.time() + self.ttl
+        for meta in metas:
+            self._metas[meta['fs_id']] = (expires_at, meta)
+
+    def cached(self, fs_id: int):
+        if self._fresh(fs_id):
+            return self._metas[fs_id][1]
+        return None
+
+    def get(self, fs_id: int) -> dict:
+        meta = self.cached(fs_id)
+        if meta is not None:
+            return meta
+        self.update(self.api.get_filemetas(self.next_batch(fs_id)))
+        meta = self.cached(fs_id)
+        if meta is None:
+            raise RequestError(404, msg=f'file {fs_id} not found')
+        return meta
+
+    def invalidate(self, fs_id: int):
+        self._metas.pop(fs_id, None)
+
+
+class AsyncFileMetaResolver(FileMetaResolver):
+
+    async def get(self, fs_id: int) -> dict:
+        meta = self.cached(fs_id)
+        if meta is not None:
+            return meta
+        self.update(await self.api.get_filemetas(self.next_batch(fs_id)))
+        meta = self.cached(fs_id)
+        if meta is None:
+            raise RequestError(404, msg=f'file {fs_id} not found')
+        return meta
+
+
+class _BaiduBase:
+
+    def __init__(self, config: SectionProxy, update_token=None, transport: Transport = default_transport, load_token=None):
+        self.transport = transport
         self._header = {'User-Agent': 'pan.baidu.com'}
         self._refresh_token = config['refresh_token']
         if not self._refresh_token:
@@ -38,9 +121,9 @@ class BaiduAPI:
         self._client_secret = config['client_secret']
         self._token_params = {'access_token': ''}
         self.update_token = update_token
-        self.refresh_token()
+        self.load_token = load_token
 
-    def _request_baidu(self, api: _BaiduURL, params_=None, data_=None, json_=None, headers: dict = None, **kwargs):
+    def _merge(self, headers: dict = None, params_=None):
         if headers is None:
             headers = self._header
         else:
@@ -49,29 +132,83 @@ class BaiduAPI:
             params_ = self._token_params
         else:
             params_.update(self._token_params)
-        res: requests.Response = self._session.request(api.method,
-                                                       api.get_url(**kwargs),
-                                                       headers=headers,
-                                                       params=params_,
-                                                       data=data_,
-                                                       json=json_)
+        return headers, params_
+
+    def _refresh_params(self) -> dict:
+        return {'refresh_token': self._refresh_token, 'client_id': self._client_id, 'client_secret': self._client_secret}
+
+    def _adopt_stored(self) -> bool:
+        stored = self.load_token()
+        if not stored.get('access_token') or stored['refresh_token'] == self._refresh_token:
+            return False
+        logging.info('refresh token rotated by another runner, reuse the stored one')
+        self._refresh_token = stored['refresh_token']
+        self._token_params['access_token'] = stored['access_token']
+        return True
+
+    @staticmethod
+    def _check_errno(api: _BaiduURL, res) -> dict:
+        if isinstance(res, bytes):
+            res = loads(res)
+        if res.get('errno', 0) != 0 or res.get('error_code', 0) != 0:
+            raise RequestError(res.get('errno') or res.get('error_code'), json.dumps(res), api.name)
+        return res
+
+
+class BaiduAPI(_BaiduBase):
+
+    def __init__(self, config: SectionProxy, update_token=None, transport: Transport = default_transport, load_token=None):
+        super().__init__(config, update_token, transport, load_token)
+        self._session = transport.session
+        self.filemetas = FileMetaResolver(self)
+        self.refresh_token()
+
+    def _request_baidu(self,
+                       api: _BaiduURL,
+                       params_=None,
+                       data_=None,
+                       json_=None,
+                       headers: dict = None,
+                       stream_key: str = None,
+                       files_=None,
+                       **kwargs):
+        headers, params_ = self._merge(headers, params_)
+        with tracer.span('baidu', api.name) as span:
+            res: requests.Response = self._session.request(api.method,
+                                                           api.get_url(**kwargs),
+                                                           headers=headers,
+                                                           params=params_,
+                                                           data=data_,
+                                                           json=json_,
+                                                           files=files_,
+                                                           stream=stream_key is not None)
+            span['status'] = res.status_code
+            if stream_key is None:
+                span['bytes'] = len(res.content)
         if res.status_code == 401:
+            res.close()
             self.refresh_token()
-            return self._request_baidu(api, params_, data_, json_, headers, **kwargs)
+            return self._request_baidu(api, params_, data_, json_, headers, stream_key, files_, **kwargs)
         if res.status_code >= 400:
             raise RequestError(res.status_code, res.text, api.name)
         if res.headers.get('content-type', '').startswith('application/json'):
-            return json.loads(res.content)
+            if stream_key is not None:
+                return JSONStream(res.iter_content(STREAM_CHUNK), stream_key, partial(self._check_errno, api))
+            return loads(res.content)
         return res.content
 
     def refresh_token(self):
-        res = self._request_baidu(_BaiduURL.refresh_token, {
-            'refresh_token': self._refresh_token,
-            'client_id': self._client_id,
-            'client_secret': self._client_secret
-        })
+        try:
+            res = self._request_baidu(_BaiduURL.refresh_token, self._refresh_params())
+        except RequestError:
+            for _ in range(TOKEN_RETRY if self.load_token else 0):
+                if self._adopt_stored():
+                    return
+                time.sleep(TOKEN_WAIT)
+            raise
+        self._refresh_token = res['refresh_token']
         if self.update_token:
-            self.update_token(res['refresh_token'])
+            self.update_token(res['refresh_token'], res['access_token'])
         self._token_params['access_token'] = res['access_token']
 
     def list_all(self, path: str, recursion: int = 0, start: int = 0):
@@ -83,42 +220,270 @@ class BaiduAPI:
         res = self._request_baidu(_BaiduURL.search, params_=params)
         return res
 
-    def get_filemeta(self, fs_id: int):
-        fsids = f'[{fs_id}]'
+    def iter_search(self, key: str, dir: str = '', page: int = 1, num: int = 500, recursion: int = 0) -> JSONStream:
+        params = {'key': key, 'dir': dir, 'page': page, 'num': num, 'recursion': recursion}
+        return self._request_baidu(_BaiduURL.search, params_=params, stream_key='list')
+
+    def get_filemetas(self, fs_ids: list) -> list:
+        fsids = f'[{",".join(str(i) for i in fs_ids)}]'
         res = self._request_baidu(_BaiduURL.filemeta, params_={'fsids': fsids, 'dlink': 1})
-        return res['list'][0]
+        return res['list']
+
+    def get_filemeta(self, fs_id: int):
+        return self.filemetas.get(fs_id)
 
     def download(self, fs_id: int, file: Path):
         filemeta = self.get_filemeta(fs_id)
         url = filemeta['dlink']
         size = filemeta['size']
-        ThreadDownload(size, url, file, headers=self._header, params=self._token_params).run()
+        try:
+            ThreadDownload(size, url, file, headers=self._header, session=self._session,
+                           params=self._token_params).run()
+        except ValueError:
+            self.filemetas.invalidate(fs_id)
+            raise
+
+    def upload_file(self, local_path: Path, remote_path: str, rtype: int = 3, workers: int = 4) -> dict:
+        size = local_path.stat().st_size
+        with ThreadPoolExecutor(workers) as pool:
+            file_md5 = pool.submit(_file_md5, local_path)
+            block_list = list(pool.map(partial(_block_md5, local_path), range(0, max(size, 1), UPLOAD_BLOCK)))
+            content_md5, slice_md5 = file_md5.result()
+            data = {
+                'path': remote_path,
+                'size': size,
+                'isdir': 0,
+                'autoinit': 1,
+                'rtype': rtype,
+                'block_list': json.dumps(block_list),
+                'content-md5': content_md5,
+                'slice-md5': slice_md5,
+            }
+            pre = self._check_errno(_BaiduURL.pre_create, self._request_baidu(_BaiduURL.pre_create, data_=data))
+            if pre.get('return_type') == 2:
+                logging.info('rapid upload %s, size: %d', remote_path, size)
+                return pre.get('info', pre)
+            upload_id = pre['uploadid']
+            parts = pre.get('block_list', [])
+            logging.info('upload %s, %d/%d blocks', remote_path, len(parts), len(block_list))
+            list(pool.map(partial(self._upload_block, local_path, remote_path, upload_id), parts))
+        data = {
+            'path': remote_path,
+            'size': size,
+            'isdir': 0,
+            'rtype': rtype,
+            'uploadid': upload_id,
+            'block_list': json.dumps(block_list),
+        }
+        return self._check_errno(_BaiduURL.create, self._request_baidu(_BaiduURL.create, data_=data))
+
+    def _upload_block(self, local_path: Path, remote_path: str, upload_id: str, partseq: int):
+        with open(local_path, 'rb') as f:
+            f.seek(partseq * UPLOAD_BLOCK)
+            block = f.read(UPLOAD_BLOCK)
+        params = {'type': 'tmpfile', 'path': remote_path, 'uploadid': upload_id, 'partseq': partseq}
+        for i in range(0, 3):
+            try:
+                res = self._request_baidu(_BaiduURL.upload, params_=params, files_={'file': ('blob', block)})
+                return self._check_errno(_BaiduURL.upload, res)
+            except Exception as e:
+                logging.error('upload block %d failed, retry: %d, err: %s', partseq, i + 1, e)
+                err = e
+        raise err
+
+
+class AsyncBaiduAPI(_BaiduBase):
+
+    def __init__(self, config: SectionProxy, update_token=None, transport: Transport = default_transport, load_token=None):
+        super().__init__(config, update_token, transport, load_token)
+        self.filemetas = AsyncFileMetaResolver(self)
+        self._refresh_lock = asyncio.Lock()
+
+    async def _request_baidu(self, api: _BaiduURL, params_=None, data_=None, json_=None, headers: dict = None, **kwargs):
+        token = self._token_params['access_token']
+        if not token and api is not _BaiduURL.refresh_token:
+            await self.refresh_token(token)
+            token = self._token_params['access_token']
+        headers, params_ = self._merge(headers, params_)
+        sess = await self.transport.async_session()
+        with tracer.span('baidu', api.name) as span:
+            async with sess.request(api.method,
+                                    api.get_url(**kwargs),
+                                    headers=headers,
+                                    params=params_,
+                                    data=data_,
+                                    json=json_) as res:
+                span['status'] = res.status
+                content = await res.read()
+                span['bytes'] = len(content)
+        if res.status == 401 and api is not _BaiduURL.refresh_token:
+            await self.refresh_token(token)
+            return await self._request_baidu(api, params_, data_, json_, headers, **kwargs)
+        if res.status >= 400:
+            raise RequestError(res.status, content.decode(errors='replace'), api.name)
+        if res.content_type == 'application/json':
+            return loads(content)
+        return content
+
+    async def refresh_token(self, stale: str = None):
+        async with self._refresh_lock:
+            if stale is not None and self._token_params['access_token'] != stale:
+                return
+            try:
+                res = await self._request_baidu(_BaiduURL.refresh_token, self._refresh_params())
+            except RequestError:
+                for _ in range(TOKEN_RETRY if self.load_token else 0):
+                    if await asyncio.to_thread(self._adopt_stored):
+                        return
+                    await asyncio.sleep(TOKEN_WAIT)
+                raise
+            self._refresh_token = res['refresh_token']
+            if self.update_token:
+                if asyncio.iscoroutinefunction(self.update_token):
+                    await self.update_token(res['refresh_token'], res['access_token'])
+                else:
+                    await asyncio.to_thread(self.update_token, res['refresh_token'], res['access_token'])
+            self._token_params['access_token'] = res['access_token']
+
+    async def list_all(self, path: str, recursion: int = 0, start: int = 0):
+        return await self._request_baidu(_BaiduURL.listall, params_={'path': path, 'recursion': recursion, 'start': start})
+
+    async def search_files(self, key: str, dir: str = '', page: int = 1, num: int = 500, recursion: int = 0):
+        params = {'key': key, 'dir': dir, 'page': page, 'num': num, 'recursion': recursion}
+        return await self._request_baidu(_BaiduURL.search, params_=params)
+
+    async def get_filemetas(self, fs_ids: list) -> list:
+        fsids = f'[{",".join(str(i) for i in fs_ids)}]'
+        res = await self._request_baidu(_BaiduURL.filemeta, params_={'fsids': fsids, 'dlink': 1})
+        return res['list']
 
-    async def get_file_content(self, queue: asyncio.Queue, fs: dict, next_byte: int, exit_queue: asyncio.Queue):
-        filemeta = self.get_filemeta(fs['fs_id'])
+    async def get_filemeta(self, fs_id: int):
+        return await self.filemetas.get(fs_id)
+
+    async def get_file_content(self, queue: BufferQueue, fs: dict, next_byte: int, exit_queue: asyncio.Queue):
+        await self._get_file_content(queue, fs, await self.get_filemeta(fs['fs_id']), next_byte, exit_queue)
+
+    async def relay_file_content(self,
+                                 fs: dict,
+                                 next_byte: int,
+                                 deadline: float,
+                                 exit_queue: asyncio.Queue = None,
+                                 chunk: int = RELAY_CHUNK):
+        await self._relay_file_content(fs, await self.get_filemeta(fs['fs_id']), next_byte, deadline, exit_queue, chunk)
+
+    async def _get_file_content(self, queue: BufferQueue, fs: dict, filemeta: dict, next_byte: int,
+                                exit_queue: asyncio.Queue):
         url = filemeta['dlink']
         size = filemeta['size']
-        async with aiohttp.ClientSession() as sess:
-            for i in range(next_byte, size, 1310720):
-                try:
-                    exit_queue.get_nowait()
-                    logging.info('receive exit')
-                    raise RequestError(0)
-                except asyncio.QueueEmpty:
-                    pass
-                if (i - next_byte) % 78643200 == 0:
-                    logging.info('%s downloading %.2f%%, queue size: %d', fs['server_filename'], i / size * 100,
-                                 queue.qsize())
-                async with sess.get(url,
-                                    headers={
-                                        'Range': f'bytes={i}-{i+1310719}',
-                                        'User-Agent': 'pan.baidu.com'
-                                    },
-                                    params=self._token_params) as res:
-                    if res.status >= 400:
-                        text = await res.text()
-                        logging.error('download failed, status:%d, resp:%s', res.status, text)
-                        raise RequestError(res.status, text)
-                    data = await res.read()
-                    await queue.put((False, fs, res.headers, data))
+        chunk = queue.chunk
+        sess = await self.transport.async_session()
+        for i in range(next_byte, size, chunk):
+            _check_exit(exit_queue)
+            if (i - next_byte) % (chunk * 60) == 0:
+                logging.info('%s downloading %.2f%%, queue size: %d, queued bytes: %d', fs['server_filename'],
+                             i / size * 100, queue.qsize(), queue.queued_bytes)
+            with tracer.span('transfer', 'wait_buffer', queued_bytes=queue.queued_bytes):
+                buf = await queue.acquire()
+            try:
+                retried = False
+                while True:
+                    token = self._token_params['access_token']
+                    with tracer.span('baidu', 'download_range', offset=i) as span:
+                        async with sess.get(url,
+                                            headers={
+                                                'Range': f'bytes={i}-{i+chunk-1}',
+                                                'User-Agent': 'pan.baidu.com'
+                                            },
+                                            params=self._token_params) as res:
+                            span['status'] = res.status
+                            if res.status >= 400:
+                                await self._dlink_failed(res, fs, token, retried)
+                                retried = True
+                                continue
+                            data = await read_into(res.content, buf)
+                            span['bytes'] = len(data)
+                    break
+            except BaseException:
+                queue.release(buf)
+                raise
+            await queue.put((False, fs, res.headers, data), len(data))
         await queue.put((True, fs, None, None))
+
+    async def _relay_file_content(self, fs: dict, filemeta: dict, next_byte: int, deadline: float,
+                                  exit_queue: asyncio.Queue, chunk: int):
+        url = filemeta['dlink']
+        size = filemeta['size']
+        sess = await self.transport.async_session()
+        for i in range(next_byte, size, chunk):
+            if time.time() >= deadline:
+                logging.info('relay timeout')
+                raise TimeOutError()
+            if exit_queue is not None:
+                _check_exit(exit_queue)
+            if (i - next_byte) % (chunk * 8) == 0:
+                logging.info('%s relaying %.2f%%', fs['server_filename'], i / size * 100)
+            retried = False
+            while True:
+                token = self._token_params['access_token']
+                with tracer.span('transfer', 'relay_range', offset=i) as span:
+                    async with sess.get(url,
+                                        headers={
+                                            'Range': f'bytes={i}-{i+chunk-1}',
+                                            'User-Agent': 'pan.baidu.com'
+                                        },
+                                        params=self._token_params) as res:
+                        span['status'] = res.status
+                        if res.status >= 400:
+                            await self._dlink_failed(res, fs, token, retried)
+                            retried = True
+                            continue
+                        upload_headers = {
+                            'Content-Length': res.headers['Content-Length'],
+                            'Content-Range': res.headers['Content-Range'],
+                        }
+                        span['bytes'] = int(upload_headers['Content-Length'])
+                        async with sess.put(fs['upload_url'], data=res.content, headers=upload_headers) as upload_res:
+                            span['upload_status'] = upload_res.status
+                            if upload_res.status >= 400:
+                                text = await upload_res.text()
+                                logging.error('upload failed, code:%d, resp:%s', upload_res.status, text)
+                                raise RequestError(upload_res.status, text, msg='upload failed')
+                break
+        logging.info('file %s finished, size: %d, avg_rate: %.2f', fs['server_filename'], size,
+                     size / (time.time() - fs['download_start_time']) / 1024)
+
+    async def _dlink_failed(self, res, fs: dict, token: str, retried: bool):
+        text = await res.text()
+        if res.status == 401 and not retried:
+            logging.warning('download unauthorized for %s, refresh token', fs['server_filename'])
+            await self.refresh_token(token)
+            return
+        logging.error('download failed, status:%d, resp:%s', res.status, text)
+        self.filemetas.invalidate(fs['fs_id'])
+        raise RequestError(res.status, text)
+
+
+def _check_exit(exit_queue: asyncio.Queue):
+    try:
+        exit_queue.get_nowait()
+    except asyncio.QueueEmpty:
+        return
+    logging.info('receive exit')
+    raise RequestError(0)
+
+
+def _block_md5(local_path: Path, offset: int) -> str:
+    with open(local_path, 'rb') as f:
+        f.seek(offset)
+        return hashlib.md5(f.read(UPLOAD_BLOCK)).hexdigest()
+
+
+def _file_md5(local_path: Path):
+    content_md5 = hashlib.md5()
+    with open(local_path, 'rb') as f:
+        data = f.read(SLICE_MD5_SIZE)
+        slice_md5 = hashlib.md5(data).hexdigest()
+        while data:
+            content_md5.update(data)
+            data = f.read(UPLOAD_BLOCK)
+    return content_md5.hexdigest(), slice_md5
@@ -0,0 +1,481 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import re
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime, timezone
+from pathlib import Path
+
+from aiohttp import web
+
+from baidu import BAIDU_HOST, BAIDU_OPENAPI_HOST, BAIDU_PCS_HOST, UPLOAD_BLOCK, AsyncBaiduAPI, BaiduAPI
+from common import override_host
+from graph import GRAPH_HOST, GraphAPI
+from main import BUFFER_BYTES, transport_file
+from tracing import tracer
+from transport import default_transport
+from utils import BufferQueue, QuickXorHash, ThreadDownload, extract_files
+
+MB = 1024 * 1024
+_BLOCK_SIZE = MB
+_SLICE = 65536
+SESSION_LIFETIME = 7200
+_RANGE = re.compile(r'bytes=(\d+)-(\d*)')
+_CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+
+
+class StandInServer:
+
+    def __init__(self, latency: float = 0.0, bandwidth: int = 0, throttle_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle_rate = throttle_rate
+        self.files = {}
+        self.items = {}
+        self.folders = {}
+        self.sessions = {}
+        self.blocks = set()
+        self.uploads = {}
+        self.stats = {'requests': 0, 'throttled': 0}
+        self._random = random.Random(seed)
+        block = random.Random(seed).randbytes(_BLOCK_SIZE)
+        self._block = memoryview(block + block)
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self.url = ''
+
+    def add_file(self, fs_id: int, size: int, path: str = '') -> dict:
+        fs = {
+            'fs_id': fs_id,
+            'size': size,
+            'path': path or f'/bench/{fs_id}.bin',
+            'server_filename': f'{fs_id}.bin',
+            'isdir': 0,
+        }
+        self.files[fs_id] = fs
+        return fs
+
+    def content(self, offset: int, length: int) -> bytes:
+        data = bytearray()
+        while length > 0:
+            start = offset % _BLOCK_SIZE
+            n = min(length, _BLOCK_SIZE)
+            data += self._block[start:start + n]
+            offset += n
+            length -= n
+        return bytes(data)
+
+    def start(self) -> str:
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(started, ), daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.url
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def upload_finished(self, sid: str) -> bool:
+        session = self.sessions.get(sid)
+        return session is not None and session['next'] >= session['total'] > 0
+
+    def _serve(self, started: threading.Event):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        app = web.Application(client_max_size=1024 * MB)
+        app.router.add_get('/oauth/2.0/token', self._token)
+        app.router.add_get('/rest/2.0/xpan/multimedia', self._multimedia)
+        app.router.add_get('/rest/2.0/xpan/file', self._search)
+        app.router.add_post('/rest/2.0/xpan/file', self._xpan_file)
+        app.router.add_post('/rest/2.0/pcs/superfile2', self._superfile2)
+        app.router.add_get('/file/{fs_id}', self._download)
+        app.router.add_put('/drives/{drive_id}/items/{file_path:.+}/content', self._upload_content)
+        app.router.add_post('/drives/{drive_id}/items/{item_id}/children', self._create_folder)
+        app.router.add_get('/drives/{drive_id}/items/{item_path:.+}', self._get_item)
+        app.router.add_post('/drives/{drive_id}/items/{item_id:.+}/createUploadSession', self._create_session)
+        app.router.add_get('/upload/{sid}', self._session_status)
+        app.router.add_put('/upload/{sid}', self._upload_range)
+        self._runner = web.AppRunner(app)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        self._loop.run_until_complete(site.start())
+        host, port = self._runner.addresses[0][:2]
+        self.url = f'http://{host}:{port}'
+        started.set()
+        self._loop.run_forever()
+
+    async def _begin(self, request: web.Request):
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def _throttle(self, sent: int, start: float):
+        if self.bandwidth:
+            delay = sent / self.bandwidth - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _token(self, request: web.Request):
+        await self._begin(request)
+        return web.json_response({'access_token': 'bench', 'refresh_token': 'bench', 'expires_in': 2592000})
+
+    async def _multimedia(self, request: web.Request):
+        await self._begin(request)
+        fs_ids = json.loads(request.query['fsids'])
+        metas = []
+        for fs_id in fs_ids:
+            meta = dict(self.files[fs_id])
+            meta['dlink'] = f'{self.url}/file/{fs_id}'
+            metas.append(meta)
+        return web.json_response({'errno': 0, 'list': metas})
+
+    async def _search(self, request: web.Request):
+        await self._begin(request)
+        return web.json_response({'errno': 0, 'list': list(self.files.values()), 'has_more': 0})
+
+    async def _xpan_file(self, request: web.Request):
+        await self._begin(request)
+        form = await request.post()
+        block_list = json.loads(form['block_list'])
+        if request.query['method'] == 'precreate':
+            missing = [i for i, md5 in enumerate(block_list) if md5 not in self.blocks]
+            if not missing:
+                return web.json_response({'errno': 0, 'return_type': 2, 'info': {'path': form['path']}})
+            upload_id = f'upload{len(self.uploads)}'
+            self.uploads[upload_id] = set()
+            return web.json_response({'errno': 0, 'return_type': 1, 'uploadid': upload_id, 'block_list': missing})
+        if any(md5 not in self.blocks for md5 in block_list):
+            return web.json_response({'errno': 31363})
+        return web.json_response({'errno': 0, 'path': form['path'], 'size': int(form['size'])})
+
+    async def _superfile2(self, request: web.Request):
+        await self._begin(request)
+        reader = await request.multipart()
+        part = await reader.next()
+        data = bytearray()
+        begin = time.perf_counter()
+        while True:
+            chunk = await part.read_chunk(_SLICE)
+            if not chunk:
+                break
+            data += chunk
+            await self._throttle(len(data), begin)
+        md5 = hashlib.md5(data).hexdigest()
+        self.blocks.add(md5)
+        self.uploads[request.query['uploadid']].add(int(request.query['partseq']))
+        return web.json_response({'errno': 0, 'md5': md5})
+
+    async def _download(self, request: web.Request):
+        await self._begin(request)
+        if self.throttle_rate and self._random.random() < self.throttle_rate:
+            self.stats['throttled'] += 1
+            return web.json_response({'errno': 31034}, status=429, headers={'Retry-After': '0'})
+        size = self.files[int(request.match_info['fs_id'])]['size']
+        start, end = 0, size - 1
+        match = _RANGE.match(request.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), size - 1)
+        length = end - start + 1
+        res = web.StreamResponse(status=206 if match else 200,
+                                 headers={
+                                     'Content-Length': str(length),
+                                     'Content-Range': f'bytes {start}-{end}/{size}',
+                                     'Content-Type': 'application/octet-stream',
+                                 })
+        await res.prepare(request)
+        begin = time.perf_counter()
+        sent = 0
+        while sent < length:
+            n = min(_SLICE, length - sent)
+            await res.write(self.content(start + sent, n))
+            sent += n
+            await self._throttle(sent, begin)
+        await res.write_eof()
+        return res
+
+    async def _read_body(self, request: web.Request) -> int:
+        begin = time.perf_counter()
+        received = 0
+        async for data in request.content.iter_chunked(_SLICE):
+            received += len(data)
+            await self._throttle(received, begin)
+        return received
+
+    async def _upload_content(self, request: web.Request):
+        await self._begin(request)
+        path = request.match_info['file_path']
+        size = await self._read_body(request)
+        item = {'id': f'item{len(self.items)}', 'name': path.rstrip(':').split('/')[-1], 'size': size}
+        self.items[path] = item
+        return web.json_response(item, status=201)
+
+    def _folder_key(self, path: str) -> tuple:
+        parent, name = path.split(':/', 1) if ':/' in path else ('root', path)
+        return parent, name.rstrip(':').lower()
+
+    async def _create_folder(self, request: web.Request):
+        await self._begin(request)
+        name = (await request.json())['name']
+        key = (request.match_info['item_id'], name.lower())
+        if key in self.folders:
+            return web.json_response({'error': {'code': 'nameAlreadyExists'}}, status=409)
+        self.folders[key] = {'id': f'folder{len(self.folders)}', 'name': name, 'folder': {}}
+        return web.json_response(self.folders[key], status=201)
+
+    async def _get_item(self, request: web.Request):
+        await self._begin(request)
+        item = self.folders.get(self._folder_key(request.match_info['item_path']))
+        if item is None:
+            return web.json_response({'error': {'code': 'itemNotFound'}}, status=404)
+        return web.json_response(item)
+
+    async def _create_session(self, request: web.Request):
+        await self._begin(request)
+        sid = f'session{len(self.sessions)}'
+        self.sessions[sid] = {'next': 0, 'total': 0}
+        expiration = datetime.fromtimestamp(time.time() + SESSION_LIFETIME, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        return web.json_response({'uploadUrl': f'{self.url}/upload/{sid}', 'expirationDateTime': expiration})
+
+    async def _session_status(self, request: web.Request):
+        await self._begin(request)
+        session = self.sessions.get(request.match_info['sid'])
+        if session is None:
+            return web.json_response({'error': {'code': 'itemNotFound'}}, status=404)
+        finished = session['next'] >= session['total'] > 0
+        return web.json_response({'nextExpectedRanges': [] if finished else [f'{session["next"]}-']})
+
+    async def _upload_range(self, request: web.Request):
+        await self._begin(request)
+        session = self.sessions.get(request.match_info['sid'])
+        if session is None:
+            return web.json_response({'error': {'code': 'itemNotFound'}}, status=404)
+        match = _CONTENT_RANGE.match(request.headers.get('Content-Range', ''))
+        if not match or int(match.group(1)) != session['next']:
+            return web.json_response({'error': {'code': 'invalidRange'}}, status=416)
+        start, end, total = (int(g) for g in match.groups())
+        received = await self._read_body(request)
+        if received != end - start + 1:
+            return web.json_response({'error': {'code': 'invalidRange'}}, status=400)
+        session['next'] = end + 1
+        session['total'] = total
+        if session['next'] >= total:
+            return web.json_response({'id': request.match_info['sid'], 'size': total}, status=201)
+        return web.json_response({'nextExpectedRanges': [f'{session["next"]}-']}, status=202)
+
+
+def _local_graph_api() -> GraphAPI:
+    return GraphAPI({}, token_provider=lambda: 'bench')
+
+
+def _point_hosts(url: str):
+    override_host(GRAPH_HOST, url)
+    override_host(BAIDU_HOST, url)
+    override_host(BAIDU_OPENAPI_HOST, url)
+    override_host(BAIDU_PCS_HOST, url)
+
+
+def _reset_hosts():
+    for host in (GRAPH_HOST, BAIDU_HOST, BAIDU_OPENAPI_HOST, BAIDU_PCS_HOST):
+        override_host(host)
+
+
+def bench_thread_download(server: StandInServer, workdir: Path, size: int, threads: int = 10, **kwargs):
+    fs = server.add_file(1, size)
+    baiduApi = BaiduAPI({'refresh_token': 'bench', 'client_id': 'bench', 'client_secret': 'bench'})
+    meta = baiduApi.get_filemeta(fs['fs_id'])
+    start = time.perf_counter()
+    ThreadDownload(meta['size'], meta['dlink'], workdir / fs['server_filename'], headers=baiduApi._header).run(threads)
+    return time.perf_counter() - start
+
+
+def bench_upload_file(server: StandInServer, workdir: Path, size: int, **kwargs):
+    local_path = workdir / 'upload.bin'
+    local_path.write_bytes(server.content(0, size))
+    graphApi = _local_graph_api()
+    start = time.perf_counter()
+    graphApi.upload_file(local_path, 'root:/bench/upload.bin:', drive_id='bench')
+    return time.perf_counter() - start
+
+
+def bench_upload_tree(server: StandInServer, workdir: Path, size: int, files: int = 256, **kwargs):
+    per_file = size // files
+    local_path = workdir / 'member.bin'
+    local_path.write_bytes(server.content(0, per_file))
+    graphApi = _local_graph_api()
+    start = time.perf_counter()
+    for i in range(files):
+        graphApi.upload_content(local_path.read_bytes(),
+                                drive_id='bench',
+                                file_path=f'root:/bench/tree/dir{i % 8}/sub{i % 3}/file{i}.bin:')
+    return time.perf_counter() - start
+
+
+async def _pipeline(server: StandInServer, baiduApi: AsyncBaiduAPI, fs: dict):
+    queue = BufferQueue(BUFFER_BYTES)
+    exit_queue = asyncio.Queue(maxsize=1)
+    task = asyncio.create_task(transport_file(queue, exit_queue, time.time()))
+    sid = fs['upload_url'].rsplit('/', 1)[-1]
+    try:
+        await baiduApi.get_file_content(queue, fs, 0, exit_queue)
+        while not server.upload_finished(sid):
+            if not exit_queue.empty():
+                raise RuntimeError('upload failed')
+            await asyncio.sleep(0.005)
+    finally:
+        task.cancel()
+
+
+async def _relay(server: StandInServer, baiduApi: AsyncBaiduAPI, fs: dict):
+    await baiduApi.relay_file_content(fs, 0, time.time() + 3600)
+    if not server.upload_finished(fs['upload_url'].rsplit('/', 1)[-1]):
+        raise RuntimeError('upload incomplete')
+
+
+def bench_pipeline(server: StandInServer, workdir: Path, size: int, relay: bool = False, **kwargs):
+    fs = server.add_file(2, size)
+    baiduApi = AsyncBaiduAPI({'refresh_token': 'bench', 'client_id': 'bench', 'client_secret': 'bench'})
+    graphApi = _local_graph_api()
+    fs['upload_url'] = graphApi.create_upload_session(f'root:{fs["path"]}:', drive_id='bench')
+    fs['download_start_time'] = time.time()
+    start = time.perf_counter()
+    default_transport.run((_relay if relay else _pipeline)(server, baiduApi, fs))
+    return time.perf_counter() - start
+
+
+def bench_baidu_upload(server: StandInServer, workdir: Path, size: int, known: float = 0.0, **kwargs):
+    local_path = workdir / 'upload.bin'
+    local_path.write_bytes(random.Random(size).randbytes(size))
+    with open(local_path, 'rb') as f:
+        for i in range(int(size * known) // UPLOAD_BLOCK):
+            server.blocks.add(hashlib.md5(f.read(UPLOAD_BLOCK)).hexdigest())
+    baiduApi = BaiduAPI({'refresh_token': 'bench', 'client_id': 'bench', 'client_secret': 'bench'})
+    start = time.perf_counter()
+    baiduApi.upload_file(local_path, '/bench/upload.bin')
+    return time.perf_counter() - start
+
+
+def bench_drive_download(server: StandInServer, workdir: Path, size: int, files: int = 8, **kwargs):
+    items = []
+    for i in range(files):
+        file_size = size // files
+        fs = server.add_file(100 + i, file_size)
+        h = QuickXorHash()
+        h.update(server.content(0, file_size))
+        items.append({
+            'id': str(fs['fs_id']),
+            'name': fs['server_filename'],
+            'path': fs['path'],
+            'size': file_size,
+            'file': {'hashes': {'quickXorHash': h.b64digest()}},
+            '@microsoft.graph.downloadUrl': f'{server.url}/file/{fs["fs_id"]}',
+        })
+    start = time.perf_counter()
+    failed = _local_graph_api().download_items('bench', items, workdir)
+    elapsed = time.perf_counter() - start
+    if failed:
+        raise RuntimeError(f'{len(failed)} files failed')
+    return elapsed
+
+
+def bench_extract_files(server: StandInServer, workdir: Path, size: int, files: int = 64, **kwargs):
+    zip_path = workdir / 'bench.zip'
+    per_file = size // files
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for i in range(files):
+            zf.writestr(f'dir{i % 8}/file{i}.bin', server.content(i * per_file, per_file))
+    start = time.perf_counter()
+    extract_files(zip_path, workdir / 'extract')
+    return time.perf_counter() - start
+
+
+SCENARIOS = {
+    'thread_download': (bench_thread_download, {'size': 64 * MB}),
+    'thread_download_latency': (bench_thread_download, {'size': 64 * MB, 'latency': 0.05}),
+    'thread_download_capped': (bench_thread_download, {'size': 32 * MB, 'bandwidth': 4 * MB}),
+    'thread_download_429': (bench_thread_download, {'size': 64 * MB, 'throttle_rate': 0.1}),
+    'upload_file': (bench_upload_file, {'size': 64 * MB}),
+    'upload_file_latency': (bench_upload_file, {'size': 32 * MB, 'latency': 0.05}),
+    'upload_tree': (bench_upload_tree, {'size': 16 * MB}),
+    'upload_tree_latency': (bench_upload_tree, {'size': 4 * MB, 'files': 64, 'latency': 0.05}),
+    'pipeline': (bench_pipeline, {'size': 64 * MB}),
+    'pipeline_latency': (bench_pipeline, {'size': 32 * MB, 'latency': 0.05}),
+    'pipeline_capped': (bench_pipeline, {'size': 32 * MB, 'bandwidth': 8 * MB}),
+    'relay': (bench_pipeline, {'size': 64 * MB, 'relay': True}),
+    'relay_latency': (bench_pipeline, {'size': 32 * MB, 'latency': 0.05, 'relay': True}),
+    'relay_capped': (bench_pipeline, {'size': 32 * MB, 'bandwidth': 8 * MB, 'relay': True}),
+    'baidu_upload': (bench_baidu_upload, {'size': 64 * MB}),
+    'baidu_upload_capped': (bench_baidu_upload, {'size': 32 * MB, 'bandwidth': 4 * MB}),
+    'baidu_upload_partial': (bench_baidu_upload, {'size': 32 * MB, 'bandwidth': 4 * MB, 'known': 0.5}),
+    'baidu_upload_rapid': (bench_baidu_upload, {'size': 64 * MB, 'known': 1.0}),
+    'drive_download': (bench_drive_download, {'size': 128 * MB}),
+    'drive_download_small': (bench_drive_download, {'size': 64 * MB, 'files': 64}),
+    'drive_download_latency': (bench_drive_download, {'size': 64 * MB, 'latency': 0.05}),
+    'extract_files': (bench_extract_files, {'size': 64 * MB}),
+}
+
+
+def run_scenario(name: str, seed: int = 0) -> dict:
+    func, params = SCENARIOS[name]
+    params = dict(params)
+    server = StandInServer(latency=params.pop('latency', 0.0),
+                           bandwidth=params.pop('bandwidth', 0),
+                           throttle_rate=params.pop('throttle_rate', 0.0),
+                           seed=seed)
+    _point_hosts(server.start())
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            elapsed = func(server, Path(workdir), **params)
+        result = {'scenario': name, 'size': params['size'], 'seconds': round(elapsed, 3),
+                  'mb_s': round(params['size'] / MB / elapsed, 2)}
+    except Exception as e:
+        logging.error('scenario %s failed, err: %s', name, e)
+        result = {'scenario': name, 'size': params['size'], 'error': str(e)}
+    finally:
+        _reset_hosts()
+        server.stop()
+    result.update(server.stats)
+    return result
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)-15s\t|\t%(levelname)s\t|\t %(message)s')
+    parser = argparse.ArgumentParser(description='offline throughput benchmark against local stand-in servers')
+    parser.add_argument('scenarios', nargs='*', help=f'scenarios to run, one of: {", ".join(SCENARIOS)}')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results as json to this file')
+    parser.add_argument('--trace', help='write a chrome trace of all runs to this file')
+    args = parser.parse_args()
+    if args.trace:
+        tracer.enable()
+    results = []
+    for name in args.scenarios or SCENARIOS:
+        result = run_scenario(name, args.seed)
+        results.append(result)
+        if 'error' in result:
+            print(f'{name:<28} failed: {result["error"]}')
+        else:
+            print(f'{name:<28} {result["mb_s"]:>9.2f} MB/s {result["seconds"]:>8.3f}s '
+                  f'requests: {result["requests"]} throttled: {result["throttled"]}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.trace:
+        tracer.save(args.trace)
+
+
+if __name__ == '__main__':
+    main()
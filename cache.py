@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import time
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+
+class ContentCache:
+
+    def __init__(self, cache_dir: Path, trust_own_writes: bool = True):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        self.trust_own_writes = trust_own_writes
+        self._own = {}
+
+    def _file(self, key: str) -> Path:
+        return self.cache_dir / hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        file = self._file(key)
+        try:
+            with open(file.with_suffix('.meta')) as f:
+                meta = json.load(f)
+            meta['body'] = file.with_suffix('.body').read_bytes()
+        except (OSError, ValueError):
+            return None
+        if meta.get('key') != key:
+            return None
+        return meta
+
+    def put(self, key: str, item: dict, body: bytes, own: bool = False):
+        file = self._file(key)
+        meta = {'key': key, 'eTag': item.get('eTag', ''), 'cTag': item.get('cTag', '')}
+        _write(file.with_suffix('.body'), body)
+        _write(file.with_suffix('.meta'), json.dumps(meta).encode())
+        if own:
+            self._own[key] = meta['eTag']
+        else:
+            self._own.pop(key, None)
+
+    def delete(self, key: str):
+        file = self._file(key)
+        file.with_suffix('.meta').unlink(missing_ok=True)
+        file.with_suffix('.body').unlink(missing_ok=True)
+        self._own.pop(key, None)
+
+    def is_own(self, key: str, etag: str) -> bool:
+        return self.trust_own_writes and etag != '' and self._own.get(key) == etag
+
+
+class ResponseCache:
+
+    def __init__(self, ttls: Dict[str, float], max_entries: int = 4096, cache_file: Path = None):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.cache_file = Path(cache_file) if cache_file else None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        if self.cache_file and self.cache_file.exists():
+            self._load()
+
+    def cacheable(self, name: str) -> bool:
+        return self.ttls.get(name, 0) > 0
+
+    def get(self, key: str) -> Optional[Tuple[bool, bytes]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def set(self, name: str, key: str, is_json: bool, body: bytes):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttls[name], is_json, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'entries': len(self._entries),
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def _load(self):
+        try:
+            with open(self.cache_file) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, (expires_at, is_json, body) in entries:
+            if expires_at >= now:
+                self._entries[key] = (expires_at, is_json, b64decode(body))
+
+    def save(self):
+        if not self.cache_file:
+            return
+        with self._lock:
+            entries = [[key, [expires_at, is_json, b64encode(body).decode()]]
+                       for key, (expires_at, is_json, body) in self._entries.items()]
+        self.cache_file.parent.mkdir(exist_ok=True, parents=True)
+        _write(self.cache_file, json.dumps(entries).encode())
+
+
+def _write(path: Path, data: bytes):
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
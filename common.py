@@ -1,4 +1,22 @@
+import codecs
+import json
+import re
 from enum import Enum
+from typing import Iterable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_HOSTS = {}
+
+
+def override_host(host: str, new_host: str = ''):
+    if new_host:
+        _HOSTS[host] = new_host
+    else:
+        _HOSTS.pop(host, None)
 
 
 class API:
@@ -13,7 +31,8 @@ class API:
 class APIEnum(Enum):
 
     def get_url(self, **kwargs) -> str:
-        return self.value.url.format(host=self.value.host, **kwargs)
+        host = _HOSTS.get(self.value.host, self.value.host)
+        return self.value.url.format(host=host, **kwargs)
 
     @property
     def method(self) -> str:
@@ -24,6 +43,124 @@ class APIEnum(Enum):
         return self.value.name
 
 
+def loads(content):
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+class JSONStream:
+
+    def __init__(self, chunks: Iterable[bytes], key: str = '', check=None):
+        self.key = key
+        self.meta = {}
+        self.check = check
+        self._found = False
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self):
+        self._skip_ws()
+        if not self.key:
+            yield from self._iter_array()
+            return
+        self._expect('{')
+        while True:
+            self._skip_ws()
+            if self._peek() == '}':
+                self._pos += 1
+                if self.check:
+                    self.check(self.meta)
+                if not self._found:
+                    raise KeyError(self.key)
+                return
+            name = self._value()
+            self._skip_ws()
+            self._expect(':')
+            self._skip_ws()
+            if name == self.key and self._peek() == '[':
+                self._found = True
+                yield from self._iter_array()
+            else:
+                self.meta[name] = self._value()
+            self._skip_ws()
+            if self._peek() == ',':
+                self._pos += 1
+
+    def _iter_array(self):
+        self._expect('[')
+        self._skip_ws()
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            self._skip_ws()
+            yield self._value()
+            self._skip_ws()
+            c = self._peek()
+            self._pos += 1
+            if c == ']':
+                return
+            if c != ',':
+                raise ValueError(f'invalid json at {self._pos}')
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        if self._pos > 65536:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        try:
+            self._buf += self._decoder.decode(next(self._chunks))
+        except StopIteration:
+            self._buf += self._decoder.decode(b'', final=True)
+            self._eof = True
+        return True
+
+    def _peek(self) -> str:
+        while self._pos >= len(self._buf):
+            if not self._fill():
+                raise ValueError('unexpected end of json')
+        return self._buf[self._pos]
+
+    def _expect(self, c: str):
+        if self._peek() != c:
+            raise ValueError(f'invalid json at {self._pos}, expect {c}')
+        self._pos += 1
+
+    def _skip_ws(self):
+        while True:
+            self._pos = _WS.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or not self._fill():
+                return
+
+    def _value(self):
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._buf, self._pos)
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+
+_WS = re.compile(r'[ \t\n\r]*')
+_DECODER = json.JSONDecoder()
+
+
+def normalize_path(path: str) -> str:
+    if path.startswith('root:'):
+        path = path[5:]
+    path = path.strip(':').strip('/')
+    return ('/' + path).lower()
+
+
 def get_content(filename: str):
     i = filename.rfind('.')
     if i != -1:
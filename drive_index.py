@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from common import RequestError, normalize_path
+from graph import GraphAPI
+
+DELTA_SELECT = 'id,name,size,eTag,cTag,file,folder,root,deleted,parentReference'
+
+
+class DriveIndex:
+
+    def __init__(self, api: GraphAPI, drive_id: str, index_file: Path):
+        self.api = api
+        self.drive_id = drive_id
+        self.index_file = Path(index_file)
+        self.delta_link = ''
+        self.items: Dict[str, dict] = {}
+        self.pending = set()
+        self._paths: Optional[Dict[str, str]] = None
+        if self.index_file.exists():
+            with open(self.index_file) as f:
+                data = json.load(f)
+            if data.get('drive_id') == drive_id:
+                self.delta_link = data['delta_link']
+                self.items = data['items']
+                self.pending = set(data.get('pending', []))
+
+    def sync(self) -> int:
+        try:
+            return self._sync()
+        except RequestError as e:
+            if e.code != 410 or not self.delta_link:
+                raise
+            logging.warning('delta token expired, resync drive %s', self.drive_id)
+            self.delta_link = ''
+            self.items = {}
+            self.pending = set()
+            return self._sync()
+
+    def _sync(self) -> int:
+        changes = 0
+        res = self.api.get_drive_delta(self.drive_id, self.delta_link, DELTA_SELECT)
+        while True:
+            for item in res['value']:
+                self._apply(item)
+                changes += 1
+            if '@odata.nextLink' not in res:
+                break
+            res = self.api.get_drive_delta(self.drive_id, res['@odata.nextLink'])
+        self.delta_link = res['@odata.deltaLink']
+        self._paths = None
+        self.save()
+        logging.info('drive index synced, changes: %d, items: %d', changes, len(self.items))
+        return changes
+
+    def _apply(self, item: dict):
+        if 'deleted' in item:
+            self.items.pop(item['id'], None)
+            self.pending.discard(item['id'])
+            return
+        file = item.get('file') or {}
+        self.items[item['id']] = {
+            'id': item['id'],
+            'name': item.get('name', ''),
+            'parent': '' if 'root' in item else item.get('parentReference', {}).get('id', ''),
+            'size': item.get('size', 0),
+            'folder': 'folder' in item or 'root' in item,
+            'hashes': file.get('hashes', {}),
+            'eTag': item.get('eTag', ''),
+            'cTag': item.get('cTag', ''),
+        }
+        if 'file' in item:
+            self.pending.add(item['id'])
+
+    def save(self):
+        tmp = self.index_file.with_name(self.index_file.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({
+                'drive_id': self.drive_id,
+                'delta_link': self.delta_link,
+                'items': self.items,
+                'pending': sorted(self.pending)
+            }, f)
+        os.replace(tmp, self.index_file)
+
+    def path(self, item_id: str) -> Optional[str]:
+        names = []
+        item = self.items.get(item_id)
+        while item is not None and item['parent']:
+            names.append(item['name'])
+            item = self.items.get(item['parent'])
+        if item is None:
+            return None
+        return '/' + '/'.join(reversed(names))
+
+    def _path_map(self) -> Dict[str, str]:
+        if self._paths is None:
+            self._paths = {}
+            for item_id in self.items:
+                path = self.path(item_id)
+                if path is not None:
+                    self._paths[path.lower()] = item_id
+        return self._paths
+
+    def get(self, path: str) -> Optional[dict]:
+        item_id = self._path_map().get(normalize_path(path))
+        return self.items.get(item_id) if item_id else None
+
+    def exists(self, path: str) -> bool:
+        return self.get(path) is not None
+
+    def children(self, path: str) -> List[dict]:
+        parent = self.get(path)
+        if parent is None:
+            return []
+        return [item for item in self.items.values() if item['parent'] == parent['id']]
+
+    def pending_files(self, path: str = '/') -> List[dict]:
+        root = normalize_path(path)
+        prefix = '' if root == '/' else root
+        files = []
+        for item_id in self.pending:
+            item = self.items.get(item_id)
+            item_path = self.path(item_id) if item else None
+            if item_path is None or not item_path.lower().startswith(prefix + '/'):
+                continue
+            files.append({
+                'id': item_id,
+                'name': item['name'],
+                'size': item['size'],
+                'file': {'hashes': item['hashes']},
+                'path': item_path[len(prefix):],
+            })
+        return files
+
+    def mark_done(self, item_ids):
+        self.pending.difference_update(item_ids)
+        self.save()
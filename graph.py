@@ -1,30 +1,64 @@
 import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from configparser import SectionProxy
+from datetime import datetime, timezone
 from functools import partial
 from pathlib import Path
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from urllib.parse import urlencode
 
 import msal
 import requests
 
-from common import API, APIEnum, RequestError, get_content
+from cache import ContentCache, ResponseCache
+from common import API, APIEnum, RequestError, get_content, loads, normalize_path
+from tracing import tracer
+from transport import Transport, default_transport
+from utils import ThreadDownload, check_hashes
 
-GraphHost = partial(API, host='https://graph.microsoft.com/v1.0')
+GRAPH_HOST = 'https://graph.microsoft.com/v1.0'
+GraphHost = partial(API, host=GRAPH_HOST)
+WALK_SELECT = 'id,name,size,folder,file,@microsoft.graph.downloadUrl'
+WALK_BUFFER = 1000
+SPLIT_SIZE = 16777216
+RANGE_SIZE = 8388608
+SESSION_MARGIN = 300
+DIRECTORY_TTLS = {
+    'users': 43200,
+    'user': 43200,
+    'photo': 86400,
+    'groups': 43200,
+    'group': 43200,
+    'group_member': 43200,
+    'group_owner': 43200,
+    'list_applications': 86400,
+    'get_application': 86400,
+}
 
 
 class _GraphURL(APIEnum):
     authority = API('authority', '{host}/{tenant_id}', host='https://login.microsoftonline.com')
     users = GraphHost('users', '{host}/users')
     user = GraphHost('user', '{host}/users/{user_id}')
-    groups = GraphHost('users', '{host}/groups')
-    group = GraphHost('user', '{host}/groups/{group_id}')
-    group_member = GraphHost('user', '{host}/groups/{group_id}/members')
-    group_owner = GraphHost('user', '{host}/groups/{group_id}/owners')
+    groups = GraphHost('groups', '{host}/groups')
+    group = GraphHost('group', '{host}/groups/{group_id}')
+    group_member = GraphHost('group_member', '{host}/groups/{group_id}/members')
+    group_owner = GraphHost('group_owner', '{host}/groups/{group_id}/owners')
     photo = GraphHost('photo', '{host}/users/{user_id}/photo/$value')
     drive = GraphHost('drive', '{host}/drives/{drive_id}')
     user_drive = GraphHost('user_drive', '{host}/users/{user_id}/drive')
     drive_item = GraphHost('drive_item', '{host}/drives/{drive_id}/items/{item_id}/children')
+    drive_item_id = GraphHost('drive_item_id', '{host}/drives/{drive_id}/items/{item_id}')
+    create_folder = GraphHost('create_folder', '{host}/drives/{drive_id}/items/{item_id}/children', method='post')
     drive_path = GraphHost('drive_path', '{host}/drives/{drive_id}/root:/{item_path}')
-    send_mail = GraphHost('users', '{host}/users/{user_id}/sendMail', method='post')
+    drive_path_children = GraphHost('drive_path_children', '{host}/drives/{drive_id}/root:/{item_path}:/children')
+    delete_path = GraphHost('delete_path', '{host}/drives/{drive_id}/root:/{item_path}', method='delete')
+    drive_delta = GraphHost('drive_delta', '{host}/drives/{drive_id}/root/delta')
+    next_link = GraphHost('next_link', '{link}')
+    send_mail = GraphHost('send_mail', '{host}/users/{user_id}/sendMail', method='post')
     upload_drive = GraphHost('upload_drive', '{host}/drives/{drive_id}/items/{file_path}/content', method='put')
     upload_user_drive = GraphHost('upload_user_drive',
                                   '{host}/users/{user_id}/drive/items/{file_path}/content',
@@ -37,25 +71,160 @@ class _GraphURL(APIEnum):
                                '{host}/drives/{drive_id}/items/{item_id}/createUploadSession',
                                method='post')
     user_upload_session = GraphHost('upload_session',
-                                    '{host}//users/{user_id}/drive/items/{item_id}/createUploadSession',
+                                    '{host}/users/{user_id}/drive/items/{item_id}/createUploadSession',
                                     method='post')
     list_applications = GraphHost('list_applications', '{host}/applications')
     get_application = GraphHost('get_application', '{host}/applications/{application_id}')
 
 
+class UploadSessionPool:
+
+    def __init__(self, api: 'GraphAPI', margin: float = SESSION_MARGIN):
+        self.api = api
+        self.margin = margin
+        self._sessions = {}
+        self._lock = Lock()
+        self._executor = None
+
+    def prefetch(self, remote_path: str, drive_id: str):
+        now = time.time()
+        with self._lock:
+            for key in [k for k, f in self._sessions.items() if f.done() and _session_expiry(f) <= now]:
+                del self._sessions[key]
+            if (drive_id, remote_path) in self._sessions:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            future = self._executor.submit(self.api.new_upload_session, remote_path, drive_id=drive_id)
+            self._sessions[(drive_id, remote_path)] = future
+
+    def get(self, remote_path: str, drive_id: str) -> str:
+        with self._lock:
+            future = self._sessions.pop((drive_id, remote_path), None)
+        if future is not None:
+            try:
+                session = future.result()
+                if _session_expiry(future) > time.time() + self.margin:
+                    return session['uploadUrl']
+                logging.info('pre-created upload session for %s expired', remote_path)
+            except Exception as e:
+                logging.warning('pre-created upload session for %s failed, err: %s', remote_path, e)
+        return self.api.create_upload_session(remote_path, drive_id=drive_id)
+
+
+def _session_expiry(future) -> float:
+    if future.exception() is not None:
+        return 0
+    expiration = future.result().get('expirationDateTime', '')
+    if not expiration:
+        return float('inf')
+    return datetime.strptime(expiration[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+
+
+_WALK_DONE = object()
+
+
+class _DriveWalker:
+
+    def __init__(self, api: 'GraphAPI', drive_id: str, select: str, workers: int):
+        self.api = api
+        self.drive_id = drive_id
+        self.select = select
+        self.workers = workers
+        self.folders = Queue()
+        self.output = Queue(maxsize=WALK_BUFFER)
+        self.stop = Event()
+        self._lock = Lock()
+        self._pending = 0
+
+    def walk(self, item: str, path: str):
+        self._pending = 1
+        self.folders.put((item, path))
+        tasks = [Thread(target=self._work, daemon=True) for _ in range(self.workers)]
+        for t in tasks:
+            t.start()
+        try:
+            while True:
+                child = self.output.get()
+                if child is _WALK_DONE:
+                    return
+                if isinstance(child, Exception):
+                    raise child
+                yield child
+        finally:
+            self.stop.set()
+            self._drain()
+            for _ in tasks:
+                self.folders.put(None)
+
+    def _work(self):
+        while True:
+            folder = self.folders.get()
+            if folder is None or self.stop.is_set():
+                return
+            try:
+                self._list(*folder)
+            except Exception as e:
+                self._emit(e)
+            with self._lock:
+                self._pending -= 1
+                if self._pending == 0:
+                    self._emit(_WALK_DONE)
+
+    def _list(self, folder_id: str, folder_path: str):
+        for child in self.api.list_children(self.drive_id, folder_id, self.select):
+            child['path'] = f'{folder_path}/{child["name"]}'
+            if 'folder' in child:
+                with self._lock:
+                    self._pending += 1
+                self.folders.put((child['id'], child['path']))
+            self._emit(child)
+
+    def _emit(self, value):
+        if not self.stop.is_set():
+            self.output.put(value)
+
+    def _drain(self):
+        while True:
+            try:
+                self.output.get_nowait()
+            except Empty:
+                return
+
+
 class GraphAPI:
 
-    def __init__(self, config: SectionProxy):
+    def __init__(self,
+                 config: SectionProxy,
+                 content_cache: ContentCache = None,
+                 response_cache: ResponseCache = None,
+                 transport: Transport = default_transport,
+                 token_provider=None):
         self.scope = ["https://graph.microsoft.com/.default"]
-        self._app = msal.ConfidentialClientApplication(
-            config["client_id"],
-            authority=_GraphURL.authority.get_url(tenant_id=config['tenant_id']),
-            client_credential=config["secret"])
-        self._session = requests.Session()
+        self.transport = transport
+        self._session = transport.session
+        self._token_provider = token_provider
+        if token_provider is None:
+            self._app = msal.ConfidentialClientApplication(
+                config["client_id"],
+                authority=_GraphURL.authority.get_url(tenant_id=config['tenant_id']),
+                client_credential=config["secret"],
+                http_client=self._session)
         self._token_header = {'Authorization': ''}
+        self.content_cache = content_cache
+        self.response_cache = response_cache
+        self._folders = {}
+        self.upload_sessions = UploadSessionPool(self)
         self.get_access_token()
 
+    @property
+    def session(self) -> requests.Session:
+        return self._session
+
     def get_access_token(self):
+        if self._token_provider is not None:
+            self._token_header['Authorization'] = self._token_provider()
+            return
         result = self._app.acquire_token_silent(self.scope, account=None)
         if not result:
             result = self._app.acquire_token_for_client(scopes=self.scope)
@@ -63,43 +232,89 @@ class GraphAPI:
             raise ValueError('failed to get access token')
         self._token_header['Authorization'] = result.get("access_token")
 
-    def _request_graph(self, api: _GraphURL, data_=None, json_=None, headers: dict = None, **kwargs):
+    def _request_graph(self,
+                       api: _GraphURL,
+                       data_=None,
+                       json_=None,
+                       headers: dict = None,
+                       params_=None,
+                       cache: bool = True,
+                       **kwargs):
+        url = api.get_url(**kwargs)
+        cache_key = ''
+        if (cache and self.response_cache and api.method == 'get' and headers is None
+                and self.response_cache.cacheable(api.name)):
+            cache_key = _response_key(url, params_)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return loads(cached[1]) if cached[0] else cached[1]
         if headers is None:
             headers = self._token_header
         else:
             headers.update(self._token_header)
-        res: requests.Response = self._session.request(api.method,
-                                                       api.get_url(**kwargs),
-                                                       headers=headers,
-                                                       data=data_,
-                                                       json=json_)
+        with tracer.span('graph', api.name) as span:
+            res: requests.Response = self._session.request(api.method,
+                                                           url,
+                                                           headers=headers,
+                                                           params=params_,
+                                                           data=data_,
+                                                           json=json_)
+            span.update(status=res.status_code, bytes=len(res.content))
         if res.status_code == 401:
             self.get_access_token()
-            return self._request_graph(api, data_, json_, headers, **kwargs)
+            return self._request_graph(api, data_, json_, headers, params_, cache, **kwargs)
         if res.status_code >= 400:
             raise RequestError(res.status_code, res.text, api.name)
-        if res.headers.get('content-type', '').startswith('application/json'):
-            return json.loads(res.content)
+        if res.status_code == 304:
+            return None
+        is_json = res.headers.get('content-type', '').startswith('application/json')
+        if cache_key:
+            self.response_cache.set(api.name, cache_key, is_json, res.content)
+        if is_json:
+            return loads(res.content)
         return res.content
 
-    def get_users(self, user_id: str = ''):
+    def _iter_values(self, api: _GraphURL, params_=None, **kwargs):
+        if self.response_cache and self.response_cache.cacheable(api.name):
+            yield from self._cached_values(api, params_, **kwargs)
+            return
+        res = self._request_graph(api, params_=params_, **kwargs)
+        yield from res['value']
+        while '@odata.nextLink' in res:
+            res = self._request_graph(_GraphURL.next_link, link=res['@odata.nextLink'])
+            yield from res['value']
+
+    def _cached_values(self, api: _GraphURL, params_=None, **kwargs) -> list:
+        cache_key = 'values:' + _response_key(api.get_url(**kwargs), params_)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            return loads(cached[1])
+        res = self._request_graph(api, params_=params_, cache=False, **kwargs)
+        values = res['value']
+        while '@odata.nextLink' in res:
+            res = self._request_graph(_GraphURL.next_link, link=res['@odata.nextLink'])
+            values.extend(res['value'])
+        self.response_cache.set(api.name, cache_key, True, json.dumps(values).encode())
+        return values
+
+    def get_users(self, user_id: str = '', select: str = '', filter_: str = '', top: int = 0):
         if user_id:
-            return self._request_graph(_GraphURL.user, user_id=user_id)
-        return self._request_graph(_GraphURL.users)['value']
+            return self._request_graph(_GraphURL.user, params_=_odata(select), user_id=user_id)
+        return list(self._iter_values(_GraphURL.users, _odata(select, filter_, top)))
 
     def get_user_photo(self, user_id: str):
         return self._request_graph(_GraphURL.photo, user_id=user_id)
 
-    def get_groups(self, group_id: str = ''):
+    def get_groups(self, group_id: str = '', select: str = '', filter_: str = '', top: int = 0, expand: str = ''):
         if group_id:
-            return self._request_graph(_GraphURL.group, group_id=group_id)
-        return self._request_graph(_GraphURL.groups)['value']
+            return self._request_graph(_GraphURL.group, params_=_odata(select, expand=expand), group_id=group_id)
+        return list(self._iter_values(_GraphURL.groups, _odata(select, filter_, top, expand)))
 
-    def get_group_member(self, group_id: str):
-        return self._request_graph(_GraphURL.group_member, group_id=group_id)['value']
+    def get_group_member(self, group_id: str, select: str = '', top: int = 0):
+        return list(self._iter_values(_GraphURL.group_member, _odata(select, top=top), group_id=group_id))
 
-    def get_group_owner(self, group_id: str):
-        return self._request_graph(_GraphURL.group_owner, group_id=group_id)['value']
+    def get_group_owner(self, group_id: str, select: str = ''):
+        return list(self._iter_values(_GraphURL.group_owner, _odata(select), group_id=group_id))
 
     def get_drive(self, user_id: str = '', drive_id: str = ''):
         if user_id != '':
@@ -115,80 +330,213 @@ class GraphAPI:
             return self._request_graph(_GraphURL.drive_path, drive_id=drive_id, item_path=item_path)
         return self._request_graph(_GraphURL.drive_item, drive_id=drive_id, item_id=item)['value']
 
+    def list_children(self, drive_id: str, item: str = 'root', select: str = ''):
+        return self._iter_values(_GraphURL.drive_item, _odata(select), drive_id=drive_id, item_id=item)
+
+    def walk_drive(self, drive_id: str, item: str = 'root', path: str = '', workers: int = 8, select: str = WALK_SELECT):
+        return _DriveWalker(self, drive_id, select, workers).walk(item, path)
+
+    def download_items(self, drive_id: str, items, local_root: Path, workers: int = 4, threads: int = 8):
+        files = Queue(maxsize=workers * 2)
+        failed = []
+
+        def download():
+            while True:
+                item = files.get()
+                if item is None:
+                    return
+                try:
+                    self.download_item(drive_id, item, local_root, threads)
+                except Exception as e:
+                    logging.error('download %s failed, err: %s', item.get('path', item['name']), e)
+                    failed.append(item)
+
+        tasks = [Thread(target=download) for _ in range(workers)]
+        for t in tasks:
+            t.start()
+        try:
+            for item in items:
+                if 'file' in item:
+                    files.put(item)
+        finally:
+            for _ in tasks:
+                files.put(None)
+            for t in tasks:
+                t.join()
+        return failed
+
+    def download_item(self, drive_id: str, item: dict, local_root: Path, threads: int = 8):
+        local_path = Path(local_root) / item.get('path', item['name']).lstrip('/')
+        local_path.parent.mkdir(exist_ok=True, parents=True)
+        size = item['size']
+        hashes = item['file'].get('hashes', {})
+        if size == 0:
+            local_path.write_bytes(b'')
+            return
+        if (local_path.exists() and local_path.stat().st_size == size
+                and not Path(f'{local_path}.ranges').exists() and check_hashes(local_path, hashes)):
+            logging.info('skip unchanged file %s', local_path)
+            return
+        url = item.get('@microsoft.graph.downloadUrl')
+        if not url:
+            url = self._request_graph(_GraphURL.drive_item_id, drive_id=drive_id,
+                                      item_id=item['id'])['@microsoft.graph.downloadUrl']
+        chunk = RANGE_SIZE if size >= SPLIT_SIZE else size
+        ThreadDownload(size, url, local_path, chunk=chunk, session=self._session,
+                       verify=lambda p: check_hashes(p, hashes)).run(min(threads, -(-size // chunk)))
+
+    def get_drive_delta(self, drive_id: str, link: str = '', select: str = ''):
+        if link:
+            return self._request_graph(_GraphURL.next_link, link=link)
+        return self._request_graph(_GraphURL.drive_delta, params_=_odata(select), drive_id=drive_id)
+
     def get_item_content(self, drive_id: str, item: str = 'root', item_path: str = ''):
-        file_item = self.get_drive_item(drive_id, item, item_path)
+        key = _cache_key(drive_id, item_path) if self.content_cache and item_path else ''
+        cached = self.content_cache.get(key) if key else None
+        if cached and self.content_cache.is_own(key, cached['eTag']):
+            return _parse_content(cached['body'])
+        if cached:
+            file_item = self._request_graph(_GraphURL.drive_path,
+                                            headers={'If-None-Match': cached['cTag'] or cached['eTag']},
+                                            drive_id=drive_id,
+                                            item_path=item_path)
+            if file_item is None:
+                return _parse_content(cached['body'])
+        else:
+            file_item = self.get_drive_item(drive_id, item, item_path)
         res = self._session.get(file_item['@microsoft.graph.downloadUrl'])
         if res.status_code >= 400:
             raise RequestError(res.status_code, res.text, msg='get item failed')
-        if res.content.startswith((b'[', b'{')):
-            return json.loads(res.content)
-        return res.content
+        if key:
+            self.content_cache.put(key, file_item, res.content)
+        return _parse_content(res.content)
+
+    def read_item(self, drive_id: str, item_path: str):
+        file_item = self.get_drive_item(drive_id, item_path=item_path)
+        res = self._session.get(file_item['@microsoft.graph.downloadUrl'])
+        if res.status_code >= 400:
+            raise RequestError(res.status_code, res.text, msg='get item failed')
+        return res.content, file_item['eTag']
+
+    def list_path_children(self, drive_id: str, item_path: str, select: str = 'name'):
+        return self._iter_values(_GraphURL.drive_path_children, _odata(select), drive_id=drive_id, item_path=item_path)
+
+    def delete_item(self, drive_id: str, item_path: str, if_match: str = ''):
+        headers = {'If-Match': if_match} if if_match else None
+        self._request_graph(_GraphURL.delete_path, headers=headers, drive_id=drive_id, item_path=item_path)
+        if self.content_cache:
+            self.content_cache.delete(_cache_key(drive_id, item_path))
 
     def send_mail(self, user_id: str, body):
         return self._request_graph(_GraphURL.send_mail, json_=body, user_id=user_id)
 
-    def list_applications(self):
-        return self._request_graph(_GraphURL.list_applications)['value']
+    def list_applications(self, select: str = '', filter_: str = '', top: int = 0):
+        return list(self._iter_values(_GraphURL.list_applications, _odata(select, filter_, top)))
 
-    def get_application(self, application_id: str):
-        return self._request_graph(_GraphURL.get_application, application_id=application_id)
+    def get_application(self, application_id: str, select: str = ''):
+        return self._request_graph(_GraphURL.get_application,
+                                   params_=_odata(select),
+                                   application_id=application_id)
 
     def create_upload_session(self, remote_path: str, user_id: str = '', drive_id: str = ''):
+        return self.new_upload_session(remote_path, user_id, drive_id)['uploadUrl']
+
+    def new_upload_session(self, remote_path: str, user_id: str = '', drive_id: str = '') -> dict:
         if user_id != '' and drive_id == '':
             api = _GraphURL.user_upload_session
         elif user_id == '' and drive_id != '':
             api = _GraphURL.upload_session
         else:
             raise ValueError('params illegal')
-        item_id = self.upload_content(b'', drive_id=drive_id, file_path=remote_path)['id']
-        res = self._request_graph(api,
-                                  json_={"item": {
-                                      "@microsoft.graph.conflictBehavior": "replace"
-                                  }},
-                                  user_id=user_id,
-                                  drive_id=drive_id,
-                                  item_id=item_id)
-        return res['uploadUrl']
+        create = partial(self._request_graph,
+                         api,
+                         json_={"item": {
+                             "@microsoft.graph.conflictBehavior": "replace"
+                         }},
+                         user_id=user_id,
+                         drive_id=drive_id)
+        if drive_id != '':
+            res = self._by_parent(drive_id, remote_path, lambda target: create(item_id=target))
+        else:
+            res = create(item_id=remote_path)
+        return res
 
     def upload_file(self, local_path: Path, remote_path: str, user_id: str = '', drive_id: str = ''):
-        if user_id != '' and drive_id == '':
-            api = _GraphURL.user_upload_session
-        elif user_id == '' and drive_id != '':
-            api = _GraphURL.upload_session
-        else:
-            raise ValueError('params illegal')
-        item_id = self.upload_content(b'', drive_id=drive_id, file_path=remote_path)['id']
+        upload_url = self.create_upload_session(remote_path, user_id, drive_id)
         file_size = local_path.stat().st_size
-        res = self._request_graph(api,
-                                  json_={"item": {
-                                      "@microsoft.graph.conflictBehavior": "replace"
-                                  }},
-                                  user_id=user_id,
-                                  drive_id=drive_id,
-                                  item_id=item_id)
-        upload_url = res['uploadUrl']
         with open(local_path, 'rb') as f:
             i = 0
             while True:
                 data = f.read(1280 * 1024)
                 if not data:
                     break
-                upload_res = self._session.put(upload_url,
-                                               data=data,
-                                               headers={
-                                                   'Content-Length': str(len(data)),
-                                                   'Content-Range': f'bytes {i}-{i+len(data)-1}/{file_size}'
-                                               })
+                with tracer.span('graph', 'upload_range', offset=i, bytes=len(data)) as span:
+                    upload_res = self._session.put(upload_url,
+                                                   data=data,
+                                                   headers={
+                                                       'Content-Length': str(len(data)),
+                                                       'Content-Range': f'bytes {i}-{i+len(data)-1}/{file_size}'
+                                                   })
+                    span['status'] = upload_res.status_code
                 if upload_res.status_code >= 400:
                     raise RequestError(upload_res.status_code, upload_res.text, msg='upload failed')
                 i += len(data)
 
+    def ensure_folder(self, drive_id: str, folder_path: str) -> str:
+        item_id = 'root'
+        parts = _split_path(folder_path)
+        for i, name in enumerate(parts):
+            key = (drive_id, '/'.join(parts[:i + 1]).lower())
+            child = self._folders.get(key)
+            if child is None:
+                child = self._create_folder(drive_id, item_id, name)
+                self._folders[key] = child
+            item_id = child
+        return item_id
+
+    def _create_folder(self, drive_id: str, parent_id: str, name: str) -> str:
+        try:
+            res = self._request_graph(_GraphURL.create_folder,
+                                      json_={
+                                          'name': name,
+                                          'folder': {},
+                                          '@microsoft.graph.conflictBehavior': 'fail'
+                                      },
+                                      drive_id=drive_id,
+                                      item_id=parent_id)
+        except RequestError as e:
+            if e.code != 409:
+                raise
+            res = self._request_graph(_GraphURL.drive_item_id, drive_id=drive_id, item_id=f'{parent_id}:/{name}')
+        return res['id']
+
+    def forget_folders(self, drive_id: str):
+        for key in [k for k in self._folders if k[0] == drive_id]:
+            self._folders.pop(key, None)
+
+    def _by_parent(self, drive_id: str, file_path: str, request):
+        parts = _split_path(file_path)
+        if not file_path.startswith('root:') or len(parts) < 2:
+            return request(file_path)
+        target = f'{self.ensure_folder(drive_id, "/".join(parts[:-1]))}:/{parts[-1]}:'
+        try:
+            return request(target)
+        except RequestError as e:
+            if e.code != 404:
+                raise
+            logging.warning('cached folder of %s is gone, resolve by path', file_path)
+            self.forget_folders(drive_id)
+            return request(file_path)
+
     def upload_content(self,
                        content: bytes,
                        drive_id: str = '',
                        file_path: str = '',
                        user_id: str = '',
-                       item_id: str = ''):
+                       item_id: str = '',
+                       if_match: str = '',
+                       conflict: str = '',
+                       cache: bool = False):
         if drive_id != '':
             if file_path != '':
                 api = _GraphURL.upload_drive
@@ -205,11 +553,50 @@ class GraphAPI:
                 raise ValueError('params illegal')
         else:
             raise ValueError('params illegal')
-        content_type = get_content(file_path)
-        return self._request_graph(api,
-                                   data_=content,
-                                   headers={'content-type': content_type},
-                                   drive_id=drive_id,
-                                   file_path=file_path,
-                                   user_id=user_id,
-                                   item_id=item_id)
+        headers = {'content-type': get_content(file_path)}
+        if if_match:
+            headers['If-Match'] = if_match
+        params = {'@microsoft.graph.conflictBehavior': conflict} if conflict else None
+        upload = partial(self._request_graph, api, data_=content, headers=headers, params_=params,
+                         drive_id=drive_id, user_id=user_id, item_id=item_id)
+        if api is _GraphURL.upload_drive:
+            res = self._by_parent(drive_id, file_path, lambda target: upload(file_path=target))
+        else:
+            res = upload(file_path=file_path)
+        if cache and self.content_cache and drive_id != '' and file_path.startswith('root:'):
+            body = content.encode() if isinstance(content, str) else content
+            self.content_cache.put(_cache_key(drive_id, file_path), res, body, own=True)
+        return res
+
+
+def _odata(select: str = '', filter_: str = '', top: int = 0, expand: str = ''):
+    params = {}
+    if select:
+        params['$select'] = select
+    if filter_:
+        params['$filter'] = filter_
+    if top:
+        params['$top'] = top
+    if expand:
+        params['$expand'] = expand
+    return params or None
+
+
+def _response_key(url: str, params_=None) -> str:
+    return f'{url}?{urlencode(sorted(params_.items()))}' if params_ else url
+
+
+def _split_path(path: str) -> list:
+    if path.startswith('root:'):
+        path = path[5:]
+    return [p for p in path.strip(':').split('/') if p]
+
+
+def _cache_key(drive_id: str, path: str) -> str:
+    return f'{drive_id}:{normalize_path(path)}'
+
+
+def _parse_content(content: bytes):
+    if content.startswith((b'[', b'{')):
+        return loads(content)
+    return content
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from threading import RLock
+from typing import Dict, List, Optional, Tuple
+
+from common import RequestError, loads
+from graph import GraphAPI
+
+LEASE_TTL = 900
+LEASE_PREFIX = 'baidu_leases'
+
+
+class LocalLeaseStore:
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True, parents=True)
+
+    @contextmanager
+    def _locked(self):
+        import fcntl
+        with open(self.root / '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self, key: str) -> Tuple[Optional[bytes], str]:
+        try:
+            value = (self.root / key).read_bytes()
+        except FileNotFoundError:
+            return None, ''
+        return value, hashlib.sha1(value).hexdigest()
+
+    def read(self, key: str) -> Tuple[Optional[bytes], str]:
+        with self._locked():
+            return self._read(key)
+
+    def write(self, key: str, value: bytes, etag: str = '', create: bool = False) -> str:
+        with self._locked():
+            current = self._read(key)[1]
+            if (create and current) or (etag and current != etag):
+                return ''
+            path = self.root / key
+            path.parent.mkdir(exist_ok=True, parents=True)
+            tmp = path.with_name(path.name + '.tmp')
+            tmp.write_bytes(value)
+            os.replace(tmp, path)
+            return hashlib.sha1(value).hexdigest()
+
+    def delete(self, key: str, etag: str = '') -> bool:
+        with self._locked():
+            current = self._read(key)[1]
+            if not current or (etag and current != etag):
+                return False
+            (self.root / key).unlink()
+            return True
+
+    def keys(self, prefix: str) -> List[str]:
+        return [f'{prefix}/{p.name}' for p in (self.root / prefix).glob('*.json')]
+
+
+class DriveLeaseStore:
+
+    def __init__(self, api: GraphAPI, drive_id: str, folder: str = ''):
+        self.api = api
+        self.drive_id = drive_id
+        self.folder = folder.strip('/')
+
+    def _path(self, key: str) -> str:
+        return f'{self.folder}/{key}' if self.folder else key
+
+    def read(self, key: str) -> Tuple[Optional[bytes], str]:
+        try:
+            return self.api.read_item(self.drive_id, self._path(key))
+        except RequestError as e:
+            if e.code == 404:
+                return None, ''
+            raise
+
+    def write(self, key: str, value: bytes, etag: str = '', create: bool = False) -> str:
+        try:
+            res = self.api.upload_content(value,
+                                          drive_id=self.drive_id,
+                                          file_path=f'root:/{self._path(key)}:',
+                                          if_match=etag,
+                                          conflict='fail' if create else '')
+        except RequestError as e:
+            if e.code in (409, 412):
+                return ''
+            raise
+        return res['eTag']
+
+    def delete(self, key: str, etag: str = '') -> bool:
+        try:
+            self.api.delete_item(self.drive_id, self._path(key), if_match=etag)
+        except RequestError as e:
+            if e.code in (404, 412):
+                return False
+            raise
+        return True
+
+    def keys(self, prefix: str) -> List[str]:
+        try:
+            return [f'{prefix}/{item["name"]}' for item in self.api.list_path_children(self.drive_id, self._path(prefix))]
+        except RequestError as e:
+            if e.code == 404:
+                return []
+            raise
+
+
+class LeaseManager:
+
+    def __init__(self, store, owner: str, ttl: float = LEASE_TTL, prefix: str = LEASE_PREFIX):
+        self.store = store
+        self.owner = owner
+        self.ttl = ttl
+        self.prefix = prefix
+        self.held: Dict[str, Tuple[str, dict]] = {}
+        self._lock = RLock()
+
+    def _key(self, fs: dict) -> str:
+        return f'{self.prefix}/{fs["fs_id"]}.json'
+
+    def _write(self, key: str, fs: dict, etag: str = '', create: bool = False) -> bool:
+        lease = {'owner': self.owner, 'expires': time.time() + self.ttl, 'file': fs}
+        with self._lock:
+            etag = self.store.write(key, json.dumps(lease).encode(), etag=etag, create=create)
+            if not etag:
+                self.held.pop(key, None)
+                return False
+            self.held[key] = (etag, fs)
+            return True
+
+    def acquire(self, fs: dict) -> bool:
+        return self._write(self._key(fs), fs, create=True)
+
+    def claim(self) -> Optional[dict]:
+        own, expired = [], []
+        now = time.time()
+        for key in self.store.keys(self.prefix):
+            value, etag = self.store.read(key)
+            if value is None:
+                continue
+            lease = loads(value)
+            if lease['owner'] == self.owner:
+                own.append((key, etag, lease))
+            elif lease['expires'] < now:
+                expired.append((key, etag, lease))
+        for key, etag, lease in own + expired:
+            if lease['owner'] != self.owner:
+                logging.info('reclaim lease %s from %s', key, lease['owner'])
+            if self._write(key, lease['file'], etag):
+                return lease['file']
+        return None
+
+    def holds(self, fs: dict) -> bool:
+        return self._key(fs) in self.held
+
+    def update(self, fs: dict) -> bool:
+        key = self._key(fs)
+        with self._lock:
+            if key not in self.held:
+                return False
+            return self._write(key, fs, self.held[key][0])
+
+    def renew(self):
+        with self._lock:
+            held = list(self.held.items())
+        for key, (etag, fs) in held:
+            with self._lock:
+                if self.held.get(key, (None, ))[0] != etag:
+                    continue
+                if not self._write(key, fs, etag):
+                    logging.warning('lease %s lost', key)
+
+    def release(self, fs: dict):
+        key = self._key(fs)
+        with self._lock:
+            held = self.held.pop(key, None)
+            if held is not None:
+                self.store.delete(key, held[0])
@@ -1,32 +1,49 @@
 import asyncio
+import cProfile
 import json
 import logging
 import os
+import pstats
 import random
 import re
+import socket
 import sys
 import time
+import tracemalloc
+from contextlib import contextmanager, suppress
 from datetime import datetime
 from pathlib import Path
 from typing import List, Tuple
 
-import aiohttp
-import requests
 
-from baidu import BaiduAPI
-from common import RequestError, TimeOutError
-from graph import GraphAPI
-from utils import decrypt, encrypt, extract_files
+from baidu import FILEMETA_BATCH, AsyncBaiduAPI, BaiduAPI
+from cache import ContentCache, ResponseCache
+from common import RequestError, TimeOutError, loads
+from drive_index import DriveIndex
+from graph import DIRECTORY_TTLS, GraphAPI
+from lease import LEASE_TTL, DriveLeaseStore, LeaseManager, LocalLeaseStore
+from tracing import tracer
+from transport import default_transport
+from utils import BufferQueue, SpillQueue, decrypt, encrypt, extract_files
 
 TIME_FOAMAT = '/%Y/%m/%d/%H/'
 TMP = Path(__file__).parent / 'tmp'
 TMP.mkdir(exist_ok=True)
 REGEX = re.compile('[\\|:"<>?#$%^&*]')
 TIMEOUT = 18000
+BUFFER_BYTES = 13107200
+MEMBER_SELECT = 'id,displayName,mail'
+EXPAND_LIMIT = 20
+ZIP_FIELDS = ('fs_id', 'path', 'server_filename', 'size')
+FILE_LIST = 'baidu_file_list.txt'
+PROFILE_TOP = 30
+LEASE_WAIT = 30
+LEASE_CHECK = 5
+TOKEN_FILE = 'refresh_token.txt'
 
 
 def get_users(api: GraphAPI):
-    users = api.get_users()
+    users = api.get_users(select='id,displayName', top=999)
     for u in users:
         logging.info('user_name: %s', u['displayName'])
         try:
@@ -38,33 +55,33 @@ def get_users(api: GraphAPI):
 
 
 def get_groups(api: GraphAPI, user_id: str):
-    groups = api.get_groups()
+    groups = api.get_groups(select='id,displayName,mail', top=999, expand=f'members($select={MEMBER_SELECT})')
     for g in groups:
         logging.info('group_name: %s', g['displayName'])
         # send_mail(api, user_id, [g['mail']])
-        members = api.get_group_member(g['id'])
+        members = g.get('members', [])
+        if len(members) >= EXPAND_LIMIT:
+            members = api.get_group_member(g['id'], select=MEMBER_SELECT, top=999)
         # send_mail(api, user_id, [m['mail'] for m in members])
 
 
 def get_applications(api: GraphAPI):
-    for app in api.list_applications():
-        application = api.get_application(app['id'])
-        logging.info('get_applications: %s', application['displayName'])
+    for app in api.list_applications(select='id,displayName', top=999):
+        logging.info('get_applications: %s', app['displayName'])
 
 
 def download_files(api: GraphAPI, user_id: str):
     drive = api.get_drive(user_id)
     logging.info('drive_id: %s', drive)
-    items = api.get_drive_item(drive)
-    for item in items:
-        if item['name'] == 'Public':
-            for d in api.get_drive_item(drive, item['id']):
-                logging.info('file_name: %s', d['name'])
-                res = requests.get(d['@microsoft.graph.downloadUrl'])
-                if res.status_code >= 400:
-                    raise RequestError(res.status_code, res.text, msg='get file failed')
-                with open(TMP / d["name"], 'wb') as f:
-                    f.write(res.content)
+    index = DriveIndex(api, drive, TMP / 'drive_index.json')
+    index.sync()
+    files = index.pending_files('/Public')
+    logging.info('changed files: %d', len(files))
+    failed = api.download_items(drive, files, TMP)
+    failed_ids = {item['id'] for item in failed}
+    index.mark_done(item['id'] for item in files if item['id'] not in failed_ids)
+    if failed:
+        raise RequestError(0, msg=f'{len(failed)} files download failed')
 
 
 def upload_files(api: GraphAPI, user_id: str):
@@ -93,16 +110,16 @@ def send_mail(api: GraphAPI, sender: str, to: List[str]):
 
 
 def get_zip_list(baiduApi: BaiduAPI, graphApi: GraphAPI, drive: str):
-    data = baiduApi.search_files('.zip', '/我的资源', recursion=1)['list']
+    data = [{k: fs[k] for k in ZIP_FIELDS} for fs in baiduApi.iter_search('.zip', '/我的资源', recursion=1)]
     logging.debug(data)
-    graphApi.upload_content(json.dumps(data), drive_id=drive, file_path='root:/compressed.txt:')
+    graphApi.upload_content(json.dumps(data), drive_id=drive, file_path='root:/compressed.txt:', cache=True)
 
 
 def upload_unzip(baiduApi: BaiduAPI, graphApi: GraphAPI, drive: str):
     compressed_list = graphApi.get_item_content(drive, item_path='compressed.txt')
 
     fs = compressed_list.pop(0)
-    graphApi.upload_content(json.dumps(compressed_list), drive_id=drive, file_path='root:/compressed.txt:')
+    graphApi.upload_content(json.dumps(compressed_list), drive_id=drive, file_path='root:/compressed.txt:', cache=True)
     logging.info('remote path: %s', fs['path'])
     try:
         temp_file = TMP / fs['server_filename']
@@ -122,55 +139,163 @@ def upload_unzip(baiduApi: BaiduAPI, graphApi: GraphAPI, drive: str):
     except Exception as e:
         logging.error('upload unzip failed, err: %s', e)
         compressed_list.append(fs)
-        graphApi.upload_content(json.dumps(compressed_list), drive_id=drive, file_path='root:/compressed.txt:')
+        graphApi.upload_content(json.dumps(compressed_list), drive_id=drive, file_path='root:/compressed.txt:', cache=True)
+
+
+def get_upload_range(graphApi: GraphAPI, fs: dict) -> Tuple[int, int]:
+    res = graphApi.session.get(fs['upload_url'])
+    if res.status_code in (401, 404):
+        return res.status_code, 0
+    if res.status_code >= 400:
+        logging.error('failed to check file %s', fs['server_filename'])
+        raise RequestError(res.status_code, res.text)
+    data = loads(res.content)
+    if len(data['nextExpectedRanges']) == 0:
+        return res.status_code, 0
+    next_range = data['nextExpectedRanges'][0]
+    return res.status_code, int(next_range[0:next_range.index('-')])
 
 
 def get_current_file(graphApi: GraphAPI, drive: str) -> Tuple[dict, int]:
     current_file = graphApi.get_item_content(drive, item_path='baidu_current_file.txt')
-    res = requests.get(current_file['upload_url'])
-    if res.status_code == 404:
+    status, index = get_upload_range(graphApi, current_file)
+    if status == 404:
         logging.info('current file finished')
         return None, 0
-    if res.status_code == 401:
+    if status == 401:
         logging.warn('unauthorized upload for %s, restart', current_file['server_filename'])
         upadte_current_file(graphApi, drive, current_file)
         return current_file, 0
-    if res.status_code >= 400:
-        logging.error('failed to check file %s', current_file['server_filename'])
-        raise RequestError(res.status_code, res.text)
-    data = json.loads(res.content)
-    if len(data['nextExpectedRanges']) == 0:
-        index = 0
-    else:
-        next_range = data['nextExpectedRanges'][0]
-        index = int(next_range[0:next_range.index('-')])
     return current_file, index
 
 
-def get_next_file(baiduApi: BaiduAPI, graphApi: GraphAPI, drive: str) -> dict:
+async def get_next_file(baiduApi: AsyncBaiduAPI, graphApi: GraphAPI, drive: str) -> dict:
     file_list = graphApi.get_item_content(drive, item_path='baidu_file_list.txt')
     if not file_list['list']:
         if not file_list['has_more']:
             return None
         page = file_list['next_page']
-        file_list = baiduApi.search_files('.', '/', page=page, recursion=1)
+        file_list = await baiduApi.search_files('.', '/', page=page, recursion=1)
         file_list['next_page'] = page + 1
     logging.info('total list: %d', len(file_list['list']))
     current_file = {'isdir': 1}
     while current_file['isdir']:
         if not file_list['list']:
-            return get_next_file(baiduApi, graphApi, drive)
+            return await get_next_file(baiduApi, graphApi, drive)
         current_file = file_list['list'].pop()
+    baiduApi.filemetas.prefetch(f['fs_id'] for f in reversed(file_list['list'][-FILEMETA_BATCH:]) if not f['isdir'])
     upadte_current_file(graphApi, drive, current_file)
-    graphApi.upload_content(json.dumps(file_list), drive_id=drive, file_path='root:/baidu_file_list.txt:')
+    graphApi.upload_content(json.dumps(file_list), drive_id=drive, file_path='root:/baidu_file_list.txt:', cache=True)
+    precreate_next_session(graphApi, drive, file_list)
     return current_file
 
 
 def upadte_current_file(graphApi: GraphAPI, drive: str, current_file: dict) -> None:
-    path = REGEX.sub('', current_file["path"])
-    current_file['upload_url'] = graphApi.create_upload_session(f'root:{path}:', drive_id=drive)
-    current_file['download_start_time'] = time.time()
-    graphApi.upload_content(json.dumps(current_file), drive_id=drive, file_path='root:/baidu_current_file.txt:')
+    create_upload_session(graphApi, drive, current_file)
+    graphApi.upload_content(json.dumps(current_file), drive_id=drive, file_path='root:/baidu_current_file.txt:', cache=True)
+
+
+def upload_path(fs: dict) -> str:
+    return f'root:{REGEX.sub("", fs["path"])}:'
+
+
+def create_upload_session(graphApi: GraphAPI, drive: str, fs: dict) -> None:
+    fs['upload_url'] = graphApi.upload_sessions.get(upload_path(fs), drive_id=drive)
+    fs['download_start_time'] = time.time()
+
+
+def precreate_next_session(graphApi: GraphAPI, drive: str, file_list: dict) -> None:
+    for fs in reversed(file_list['list']):
+        if not fs['isdir']:
+            graphApi.upload_sessions.prefetch(upload_path(fs), drive_id=drive)
+            return
+
+
+async def pop_next_file(baiduApi: AsyncBaiduAPI, leases: LeaseManager) -> dict:
+    while True:
+        value, etag = leases.store.read(FILE_LIST)
+        file_list = loads(value)
+        page = 0
+        if not file_list['list']:
+            if not file_list['has_more']:
+                return None
+            page = file_list['next_page']
+            file_list = await baiduApi.search_files('.', '/', page=page, recursion=1)
+            file_list['next_page'] = page + 1
+        current_file = None
+        for fs in reversed(file_list['list']):
+            if not fs['isdir'] and leases.acquire(fs):
+                current_file = fs
+                break
+        commit_pop(leases, file_list, etag, current_file['fs_id'] if current_file else None, page)
+        if current_file is not None:
+            return current_file
+        if file_list['list']:
+            logging.info('remaining files are leased by other runners, wait')
+            await asyncio.sleep(LEASE_WAIT)
+
+
+def commit_pop(leases: LeaseManager, file_list: dict, etag: str, fs_id: int, page: int) -> None:
+    file_list['list'] = [f for f in file_list['list'] if not f['isdir'] and f['fs_id'] != fs_id]
+    while not leases.store.write(FILE_LIST, json.dumps(file_list).encode(), etag=etag):
+        logging.info('file list changed by another runner, retry')
+        value, etag = leases.store.read(FILE_LIST)
+        stored = loads(value)
+        if page and not stored['list'] and stored['next_page'] == page:
+            continue
+        stored['list'] = [f for f in stored['list'] if not f['isdir'] and f['fs_id'] != fs_id]
+        file_list.update(stored)
+
+
+async def claim_file(baiduApi: AsyncBaiduAPI, graphApi: GraphAPI, drive: str, leases: LeaseManager) -> Tuple[dict, int]:
+    while True:
+        fs = leases.claim()
+        if fs is None:
+            fs = await pop_next_file(baiduApi, leases)
+            if fs is None:
+                return None, 0
+        if 'upload_url' not in fs:
+            create_upload_session(graphApi, drive, fs)
+            if not leases.update(fs):
+                continue
+            return fs, 0
+        status, index = get_upload_range(graphApi, fs)
+        if status == 404:
+            logging.info('leased file %s finished', fs['server_filename'])
+            leases.release(fs)
+            continue
+        if status == 401:
+            logging.warn('unauthorized upload for %s, restart', fs['server_filename'])
+            create_upload_session(graphApi, drive, fs)
+            if not leases.update(fs):
+                continue
+        return fs, index
+
+
+async def next_transport_file(baiduApi: AsyncBaiduAPI, graphApi: GraphAPI, drive: str,
+                              leases: LeaseManager = None) -> Tuple[dict, int]:
+    if leases:
+        return await claim_file(baiduApi, graphApi, drive, leases)
+    current_file, next_byte = get_current_file(graphApi, drive)
+    if current_file is None:
+        current_file = await get_next_file(baiduApi, graphApi, drive)
+    return current_file, next_byte
+
+
+async def renew_leases(leases: LeaseManager):
+    while True:
+        await asyncio.sleep(leases.ttl / 3)
+        try:
+            await asyncio.to_thread(leases.renew)
+        except Exception as e:
+            logging.error('renew leases failed, err:%s', e)
+
+
+async def watch_lease(leases: LeaseManager, fs: dict, exit_queue: asyncio.Queue):
+    while leases.holds(fs):
+        await asyncio.sleep(LEASE_CHECK)
+    logging.warning('lease of %s lost, stop transfer', fs['server_filename'])
+    put_nowait(exit_queue, 0)
 
 
 def put_nowait(queue: asyncio.Queue, item):
@@ -180,53 +305,134 @@ def put_nowait(queue: asyncio.Queue, item):
         pass
 
 
-async def transport_file(queue: asyncio.Queue, exit_queue: asyncio.Queue, start_time: float):
+async def transport_file(queue: BufferQueue, exit_queue: asyncio.Queue, start_time: float, leases: LeaseManager = None):
     upload_headers = {}
-    async with aiohttp.ClientSession() as sess:
-        while True:
-            if time.time() - start_time >= TIMEOUT:
-                put_nowait(exit_queue, 0)
-                logging.info('exit upload')
-                return
+    sess = await default_transport.async_session()
+    while True:
+        if time.time() - start_time >= TIMEOUT:
+            put_nowait(exit_queue, 0)
+            logging.info('exit upload')
+            return
+        try:
+            finished, fs, resp_headers, data = await queue.get()
+            if leases and not leases.holds(fs):
+                if data is not None:
+                    queue.release(data)
+                continue
+            if finished:
+                logging.info('file %s finished, size: %d, avg_rate: %.2f', fs['server_filename'], fs['size'],
+                             fs['size'] / (time.time() - fs['download_start_time']) / 1024)
+                continue
+            upload_headers['Content-Length'] = resp_headers['Content-Length']
+            upload_headers['Content-Range'] = resp_headers['Content-Range']
             try:
-                finished, fs, resp_headers, data = await queue.get()
-                if finished:
-                    logging.info('file %s finished, size: %d, avg_rate: %.2f', fs['server_filename'], fs['size'],
-                                 fs['size'] / (time.time() - fs['download_start_time']) / 1024)
-                    continue
-                upload_headers['Content-Length'] = resp_headers['Content-Length']
-                upload_headers['Content-Range'] = resp_headers['Content-Range']
-                async with sess.put(fs['upload_url'], data=data, headers=upload_headers) as upload_res:
-                    if upload_res.status >= 400:
-                        logging.error('upload failed, code:%d, resp:%s', upload_res.status, await upload_res.text())
-                        put_nowait(exit_queue, 0)
-            except Exception as e:
-                put_nowait(exit_queue, 0)
-                logging.error('upload failed, err:%s', e)
+                with tracer.span('graph', 'upload_range', range=upload_headers['Content-Range'], bytes=len(data)) as span:
+                    async with sess.put(fs['upload_url'], data=data, headers=upload_headers) as upload_res:
+                        span['status'] = upload_res.status
+                        if upload_res.status >= 400:
+                            logging.error('upload failed, code:%d, resp:%s', upload_res.status, await upload_res.text())
+                            put_nowait(exit_queue, 0)
+            finally:
+                queue.release(data)
+        except Exception as e:
+            put_nowait(exit_queue, 0)
+            logging.error('upload failed, err:%s', e)
 
 
-async def baidu_to_onedrive(baiduApi: BaiduAPI, graphApi: GraphAPI, drive: str):
+async def baidu_to_onedrive(baiduApi: AsyncBaiduAPI,
+                            graphApi: GraphAPI,
+                            drive: str,
+                            relay: bool = False,
+                            spill_bytes: int = 0,
+                            leases: LeaseManager = None):
     start_time = time.time()
-    queue = asyncio.Queue(maxsize=10)
+    await baiduApi.refresh_token('')
+    if spill_bytes:
+        queue = SpillQueue(BUFFER_BYTES, TMP / 'spill.ring', spill_bytes)
+    else:
+        queue = BufferQueue(BUFFER_BYTES)
     exit_queue = asyncio.Queue(maxsize=1)
-    asyncio.create_task(transport_file(queue, exit_queue, start_time))
-    while True:
-        try:
-            if time.time() - start_time >= TIMEOUT:
-                logging.info('exit transport')
-                return
-            current_file, next_byte = get_current_file(graphApi, drive)
-            if current_file is None:
-                current_file = get_next_file(baiduApi, graphApi, drive)
-            if current_file is None:
+    if not relay:
+        task = asyncio.create_task(transport_file(queue, exit_queue, start_time, leases))
+    if leases:
+        renew_task = asyncio.create_task(renew_leases(leases))
+    try:
+        while True:
+            try:
+                if time.time() - start_time >= TIMEOUT:
+                    logging.info('exit transport')
+                    return
+                current_file, next_byte = await next_transport_file(baiduApi, graphApi, drive, leases)
+                if current_file is None:
+                    return
+                logging.info('transport file: %s', current_file['path'])
+                if leases:
+                    watcher = asyncio.create_task(watch_lease(leases, current_file, exit_queue))
+                try:
+                    if relay:
+                        await baiduApi.relay_file_content(current_file, next_byte, start_time + TIMEOUT, exit_queue)
+                    else:
+                        await baiduApi.get_file_content(queue, current_file, next_byte, exit_queue)
+                finally:
+                    if leases:
+                        watcher.cancel()
+            except TimeOutError:
                 return
-            logging.info('transport file: %s', current_file['path'])
-            await baiduApi.get_file_content(queue, current_file, next_byte, exit_queue)
-        except TimeOutError:
-            return
-        except Exception as e:
-            logging.error('transport file to onedrive failed,file:%s, err:%s', current_file, e)
-        await asyncio.sleep(random.randint(200, 300))
+            except Exception as e:
+                logging.error('transport file to onedrive failed,file:%s, err:%s', current_file, e)
+            await asyncio.sleep(random.randint(200, 300))
+    finally:
+        if leases:
+            renew_task.cancel()
+        if not relay:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        if spill_bytes:
+            logging.info('spilled bytes: %d', queue.spilled_bytes)
+            queue.close()
+
+
+class TokenFile:
+
+    def __init__(self, api: GraphAPI, drive: str):
+        self.store = DriveLeaseStore(api, drive)
+        self.key = os.getenv('refresh_token_key')
+        self.associated_data = os.getenv('refresh_token_associated_data')
+        self.etag = ''
+
+    def load(self) -> dict:
+        value, self.etag = self.store.read(TOKEN_FILE)
+        if value is None:
+            return {}
+        token = decrypt(self.key, self.associated_data, **loads(value))
+        if token.startswith('{'):
+            return loads(token)
+        return {'refresh_token': token}
+
+    def save(self, refresh_token: str, access_token: str):
+        token = json.dumps({'refresh_token': refresh_token, 'access_token': access_token})
+        iv, ciphertext, tag = encrypt(self.key, token, self.associated_data)
+        value = json.dumps({'iv': iv, 'ciphertext': ciphertext, 'tag': tag}).encode()
+        etag = self.store.write(TOKEN_FILE, value, etag=self.etag, create=not self.etag)
+        if not etag:
+            logging.warning('refresh token changed by another runner, keep the stored one')
+            etag = self.store.read(TOKEN_FILE)[1]
+        self.etag = etag
+
+
+def get_leases(api: GraphAPI, drive: str, backend: str) -> LeaseManager:
+    if backend == 'drive':
+        store = DriveLeaseStore(api, drive)
+    elif backend == 'local':
+        store = LocalLeaseStore(os.getenv('lease_dir') or TMP / 'leases')
+        if store.read(FILE_LIST)[0] is None:
+            file_list = api.get_item_content(drive, item_path=FILE_LIST)
+            store.write(FILE_LIST, json.dumps(file_list).encode(), create=True)
+    else:
+        raise ValueError('config error')
+    owner = os.getenv('runner_id') or f'{socket.gethostname()}-{os.getpid()}'
+    return LeaseManager(store, owner, float(os.getenv('lease_ttl') or LEASE_TTL))
 
 
 def main():
@@ -236,7 +442,39 @@ def main():
     if len(sys.argv) != 2:
         logging.error('invalid params %s', sys.argv)
         return
-    job = sys.argv[1]
+    with profiling():
+        run_job(sys.argv[1])
+
+
+@contextmanager
+def profiling():
+    trace_file = os.getenv('trace_file')
+    if trace_file:
+        tracer.enable()
+    profiler = None
+    if os.getenv('profile_file'):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if os.getenv('tracemalloc_frames'):
+        tracemalloc.start(int(os.getenv('tracemalloc_frames')))
+    try:
+        yield
+    finally:
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            for stat in snapshot.statistics('lineno')[:PROFILE_TOP]:
+                logging.info('tracemalloc: %s', stat)
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(os.getenv('profile_file'))
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        if trace_file:
+            tracer.save(trace_file)
+            logging.info('trace saved to %s, events: %d, dropped: %d', trace_file, len(tracer.events), tracer.dropped)
+
+
+def run_job(job: str):
     graphConfig = {
         'client_id': os.getenv('client_id'),
         'tenant_id': os.getenv('tenant_id'),
@@ -246,26 +484,25 @@ def main():
     for v in graphConfig.values():
         if not v:
             raise ValueError('config error')
-    api = GraphAPI(graphConfig)
+    response_cache = None
+    if job == 'graph_test':
+        response_cache = ResponseCache(DIRECTORY_TTLS, cache_file=TMP / 'response_cache.json')
+    api = GraphAPI(graphConfig, ContentCache(TMP / 'content_cache'), response_cache)
     if job == 'graph_test':
         get_users(api)
         get_groups(api, graphConfig['user_id'])
         get_applications(api)
+        response_cache.save()
+        logging.info('response cache stats: %s', response_cache.stats())
         # download_files(api, graphConfig['user_id'])
         # upload_files(api, graphConfig['user_id'])
     elif job == 'baidu_to_onedrive':
-        refresh_token = ''
+        if int(os.getenv('shard_count') or 1) > 1 and not os.getenv('lease_backend'):
+            raise ValueError('lease_backend is required to run more than one shard')
         drive = api.get_drive(graphConfig['user_id'])
-
-        def update_token(t):
-            iv, ciphertext, tag = encrypt(os.getenv('refresh_token_key'), t, os.getenv('refresh_token_associated_data'))
-            cipher_data = {'iv': iv, 'ciphertext': ciphertext, 'tag': tag}
-            api.upload_content(json.dumps(cipher_data), drive_id=drive, file_path='root:/refresh_token.txt:')
-
+        token_file = TokenFile(api, drive)
         try:
-            token_file = api.get_item_content(drive, item_path='refresh_token.txt')
-            refresh_token = decrypt(os.getenv('refresh_token_key'), os.getenv('refresh_token_associated_data'),
-                                    **token_file)
+            stored = token_file.load()
         except RequestError as e:
             logging.error('update token failed, err: %s', e)
             return
@@ -273,13 +510,20 @@ def main():
         baiduConfig = {
             'client_id': os.getenv('baidu_client_id'),
             'client_secret': os.getenv('baidu_client_secret'),
-            'refresh_token': refresh_token or os.getenv('refresh_token'),
+            'refresh_token': stored.get('refresh_token') or os.getenv('refresh_token'),
         }
         for v in baiduConfig.values():
             if not v:
                 raise ValueError('config error')
-        baiduApi = BaiduAPI(baiduConfig, update_token)
-        asyncio.run(baidu_to_onedrive(baiduApi, api, drive))
+        baiduApi = AsyncBaiduAPI(baiduConfig, token_file.save, load_token=token_file.load)
+        leases = None
+        if os.getenv('lease_backend'):
+            leases = get_leases(api, drive, os.getenv('lease_backend'))
+        default_transport.run(
+            baidu_to_onedrive(baiduApi, api, drive,
+                              relay=os.getenv('transfer_mode') == 'relay',
+                              spill_bytes=int(os.getenv('spill_bytes') or 0),
+                              leases=leases))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+from common import JSONStream, RequestError
+
+BODY = {
+    'errno': 0,
+    'list': [{'fs_id': i, 'path': f'/我的资源/文件{i}.zip', 'size': i * 1024} for i in range(20)],
+    'has_more': 1,
+}
+
+
+def _chunks(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_stream_every_chunk_size():
+    data = json.dumps(BODY, ensure_ascii=False, indent=1).encode()
+    for size in range(1, 40):
+        stream = JSONStream(_chunks(data, size), 'list')
+        assert list(stream) == BODY['list'], size
+        assert stream.meta == {'errno': 0, 'has_more': 1}
+
+
+def test_stream_array():
+    data = json.dumps(BODY['list']).encode()
+    assert list(JSONStream(_chunks(data, 3))) == BODY['list']
+    assert list(JSONStream([b' [ ] '])) == []
+
+
+def test_stream_missing_key():
+    with pytest.raises(KeyError):
+        list(JSONStream(_chunks(b'{"errno": -6, "request_id": 1}', 4), 'list'))
+
+
+def test_stream_check_error_body():
+
+    def check(meta):
+        if meta.get('errno', 0) != 0:
+            raise RequestError(meta['errno'], json.dumps(meta))
+
+    with pytest.raises(RequestError):
+        list(JSONStream(_chunks(b'{"errno": -6, "request_id": 1}', 4), 'list', check))
+    with pytest.raises(RequestError):
+        list(JSONStream([b'{"list": [1, 2], "errno": 2}'], 'list', check))
+    assert list(JSONStream([b'{"list": [1, 2], "errno": 0}'], 'list', check)) == [1, 2]
+
+
+def test_stream_truncated():
+    with pytest.raises(ValueError):
+        list(JSONStream([b'{"list": [1, 2'], 'list'))
@@ -0,0 +1,75 @@
+import asyncio
+import json
+
+from lease import LeaseManager, LocalLeaseStore
+from main import FILE_LIST, commit_pop, pop_next_file
+
+
+def _file(fs_id: int) -> dict:
+    return {'fs_id': fs_id, 'isdir': 0, 'server_filename': f'{fs_id}.bin', 'path': f'/{fs_id}.bin'}
+
+
+def test_local_store_cas(tmp_path):
+    store = LocalLeaseStore(tmp_path)
+    etag = store.write('a.json', b'1', create=True)
+    assert etag
+    assert store.write('a.json', b'2', create=True) == ''
+    assert store.write('a.json', b'2', etag='stale') == ''
+    etag = store.write('a.json', b'2', etag=etag)
+    assert store.read('a.json') == (b'2', etag)
+    assert not store.delete('a.json', 'stale')
+    assert store.delete('a.json', etag)
+    assert store.read('a.json') == (None, '')
+
+
+def test_acquire_is_exclusive(tmp_path):
+    store = LocalLeaseStore(tmp_path)
+    a = LeaseManager(store, 'a')
+    b = LeaseManager(store, 'b')
+    assert a.acquire(_file(1))
+    assert not b.acquire(_file(1))
+    assert b.claim() is None
+    assert a.claim() == _file(1)
+    a.release(_file(1))
+    assert b.acquire(_file(1))
+
+
+def test_reclaim_expired_lease(tmp_path):
+    store = LocalLeaseStore(tmp_path)
+    a = LeaseManager(store, 'a', ttl=-1)
+    b = LeaseManager(store, 'b')
+    fs = _file(1)
+    fs['upload_url'] = 'https://upload/1'
+    assert a.acquire(fs)
+    assert b.claim() == fs
+    assert b.holds(fs)
+    a.renew()
+    assert not a.holds(fs)
+    assert not a.update(fs)
+    assert b.update(fs)
+
+
+def test_commit_pop_retries_on_conflict(tmp_path):
+    store = LocalLeaseStore(tmp_path)
+    leases = LeaseManager(store, 'a')
+    file_list = {'list': [_file(1), _file(2), _file(3)], 'has_more': 0, 'next_page': 2}
+    store.write(FILE_LIST, json.dumps(file_list).encode())
+    etag = store.read(FILE_LIST)[1]
+    other = dict(file_list, list=[_file(1), _file(2)])
+    store.write(FILE_LIST, json.dumps(other).encode(), etag=etag)
+    commit_pop(leases, file_list, etag, 2, 0)
+    stored = json.loads(store.read(FILE_LIST)[0])
+    assert stored['list'] == [_file(1)]
+    assert file_list['list'] == [_file(1)]
+
+
+def test_pop_skips_files_leased_by_others(tmp_path):
+    store = LocalLeaseStore(tmp_path)
+    a = LeaseManager(store, 'a')
+    b = LeaseManager(store, 'b')
+    file_list = {'list': [_file(1), _file(2), _file(3)], 'has_more': 0, 'next_page': 2}
+    store.write(FILE_LIST, json.dumps(file_list).encode())
+    assert b.acquire(_file(3))
+    assert asyncio.run(pop_next_file(None, a)) == _file(2)
+    assert a.holds(_file(2))
+    assert json.loads(store.read(FILE_LIST)[0])['list'] == [_file(1), _file(3)]
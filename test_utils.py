@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import os
+from base64 import b64encode
+from collections import deque
+
+from utils import QuickXorHash, SpillQueue, check_hashes
+
+CHUNK = 16
+
+
+def _reference_quick_xor(data: bytes) -> str:
+    acc = 0
+    for i, b in enumerate(data):
+        shift = i * 11 % 160
+        acc ^= ((b << shift) | (b >> (160 - shift))) & ((1 << 160) - 1)
+    res = bytearray(acc.to_bytes(20, 'little'))
+    for i, b in enumerate(len(data).to_bytes(8, 'little')):
+        res[12 + i] ^= b
+    return b64encode(bytes(res)).decode()
+
+
+def test_quick_xor_empty():
+    assert QuickXorHash().b64digest() == 'AAAAAAAAAAAAAAAAAAAAAAAAAAA='
+
+
+def test_quick_xor_matches_reference():
+    for size in (1, 20, 159, 160, 161, 320, 1000, 4099):
+        data = os.urandom(size)
+        h = QuickXorHash()
+        h.update(data)
+        assert h.b64digest() == _reference_quick_xor(data), size
+
+
+def test_quick_xor_split_updates():
+    data = os.urandom(2000)
+    expected = _reference_quick_xor(data)
+    for step in (1, 7, 159, 160, 161, 999):
+        h = QuickXorHash()
+        for i in range(0, len(data), step):
+            h.update(data[i:i + step])
+        assert h.b64digest() == expected, step
+
+
+def test_check_hashes(tmp_path):
+    data = os.urandom(5000)
+    path = tmp_path / 'data.bin'
+    path.write_bytes(data)
+    assert check_hashes(path, {'quickXorHash': _reference_quick_xor(data)})
+    assert not check_hashes(path, {'quickXorHash': _reference_quick_xor(data[:-1])})
+    assert check_hashes(path, {'sha1Hash': hashlib.sha1(data).hexdigest().upper()})
+    assert check_hashes(path, {})
+
+
+async def _put(queue: SpillQueue, payload: bytes):
+    buf = await queue.acquire()
+    buf[:len(payload)] = payload
+    await queue.put((False, {}, {}, memoryview(buf)[:len(payload)]), len(payload))
+
+
+async def _get(queue: SpillQueue) -> bytes:
+    _, _, _, data = await queue.get()
+    value = bytes(data)
+    queue.release(data)
+    return value
+
+
+def test_alloc_wraps_around(tmp_path):
+    queue = SpillQueue(CHUNK * 2, tmp_path / 'spill.ring', CHUNK * 4, CHUNK)
+    try:
+        assert queue._alloc(CHUNK) == 0
+        queue._spans = deque([(CHUNK * 2, CHUNK)])
+        assert queue._alloc(CHUNK) == CHUNK * 3
+        queue._spans = deque([(CHUNK * 2, CHUNK * 2)])
+        assert queue._alloc(CHUNK) == 0
+        assert queue._alloc(CHUNK * 3) == -1
+        queue._spans = deque([(CHUNK * 2, CHUNK * 2), (0, CHUNK)])
+        assert queue._alloc(CHUNK) == CHUNK
+        assert queue._alloc(CHUNK * 2) == -1
+        queue._spans.clear()
+    finally:
+        queue.close()
+
+
+def test_spill_keeps_order_across_wrap(tmp_path):
+
+    async def run():
+        queue = SpillQueue(CHUNK * 2, tmp_path / 'spill.ring', CHUNK * 3, CHUNK)
+        held = await queue.acquire()
+        payloads = [bytes([i]) * CHUNK for i in range(1, 6)]
+        for p in payloads[:3]:
+            await _put(queue, p)
+        assert queue.spilled_bytes == CHUNK * 3
+        assert await _get(queue) == payloads[0]
+        await _put(queue, payloads[3])
+        assert queue._spans[-1] == (0, CHUNK)
+        await _put(queue, payloads[4])
+        assert queue.spilled_bytes == CHUNK * 4
+        assert [await _get(queue) for _ in payloads[1:]] == payloads[1:]
+        assert not queue._spans
+        queue.release(held)
+        assert queue._pool.qsize() == 2
+        queue.close()
+
+    asyncio.run(run())
+    assert not (tmp_path / 'spill.ring').exists()
+
+
+def test_close_releases_queued_chunks(tmp_path):
+
+    async def run():
+        queue = SpillQueue(CHUNK, tmp_path / 'spill.ring', CHUNK * 2, CHUNK)
+        await _put(queue, b'x' * CHUNK)
+        await queue.put((True, {}, None, None))
+        queue.close()
+        assert queue._mmap.closed
+
+    asyncio.run(run())
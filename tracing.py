@@ -0,0 +1,71 @@
+import asyncio
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock, get_ident
+
+MAX_EVENTS = 1000000
+
+
+class Tracer:
+
+    def __init__(self, max_events: int = MAX_EVENTS):
+        self.enabled = False
+        self.max_events = max_events
+        self.dropped = 0
+        self.events = []
+        self._lock = Lock()
+        self._origin = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def span(self, cat: str, name: str, **args):
+        if not self.enabled:
+            yield args
+            return
+        start = time.perf_counter()
+        try:
+            yield args
+        except BaseException as e:
+            args['error'] = repr(e)
+            raise
+        finally:
+            self._add({
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': (start - self._origin) * 1e6,
+                'dur': (time.perf_counter() - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': _tid(),
+                'args': args,
+            })
+
+    def _add(self, event: dict):
+        with self._lock:
+            if len(self.events) >= self.max_events:
+                self.dropped += 1
+                return
+            self.events.append(event)
+
+    def save(self, path: Path):
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'dropped': self.dropped}}, f)
+
+
+def _tid() -> int:
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) if task is not None else get_ident()
+
+
+tracer = Tracer()
@@ -0,0 +1,74 @@
+import asyncio
+from threading import Lock
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_HOSTS = 16
+POOL_SIZE = 32
+CONNECTION_LIMIT = 100
+DNS_TTL = 600
+KEEPALIVE_TIMEOUT = 60
+
+
+class Transport:
+
+    def __init__(self,
+                 pool_size: int = POOL_SIZE,
+                 limit: int = CONNECTION_LIMIT,
+                 dns_ttl: int = DNS_TTL,
+                 keepalive_timeout: float = KEEPALIVE_TIMEOUT):
+        self.pool_size = pool_size
+        self.limit = limit
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+        self._async_sessions = {}
+        self._lock = Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=self.pool_size)
+                self._session = requests.Session()
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+            return self._session
+
+    async def async_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        sess = self._async_sessions.get(loop)
+        if sess is None or sess.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             limit_per_host=self.pool_size,
+                                             ttl_dns_cache=self.dns_ttl,
+                                             keepalive_timeout=self.keepalive_timeout)
+            sess = aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300))
+            self._async_sessions[loop] = sess
+        return sess
+
+    async def close_async(self):
+        sess = self._async_sessions.pop(asyncio.get_running_loop(), None)
+        if sess is not None:
+            await sess.close()
+
+    def run(self, coro):
+        return asyncio.run(self._run(coro))
+
+    async def _run(self, coro):
+        try:
+            return await coro
+        finally:
+            await self.close_async()
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+default_transport = Transport()
@@ -1,14 +1,26 @@
+import asyncio
+import hashlib
 import logging
+import mmap
 import secrets
 import zipfile
 from base64 import b64decode, b64encode
+from collections import deque
 from pathlib import Path
 from queue import Queue
 from threading import Lock, Thread
 
+import aiohttp
 import requests
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
+from tracing import tracer
+from transport import default_transport
+
+CHUNK_SIZE = 1310720
+HASH_BLOCK = 4194304
+_MASK_160 = (1 << 160) - 1
+
 
 def encrypt(key: str, plaintext: str, associated_data: str):
     iv = secrets.token_hex()
@@ -49,6 +61,56 @@ def extract_files(zip_path: Path, extract_path: Path):
                 f.write(zf.read(zip_file))
 
 
+class QuickXorHash:
+
+    def __init__(self):
+        self.length = 0
+        self._acc = 0
+
+    def update(self, data: bytes):
+        rows = (self.length % 160 + len(data) + 159) // 160
+        x = int.from_bytes(data, 'little') << (self.length % 160 * 8)
+        while rows > 1:
+            rows = (rows + 1) // 2
+            bits = rows * 1280
+            x = (x >> bits) ^ (x & ((1 << bits) - 1))
+        self._acc ^= x
+        self.length += len(data)
+
+    def digest(self) -> bytes:
+        value = 0
+        for i, b in enumerate(self._acc.to_bytes(160, 'little')):
+            shift = i * 11 % 160
+            value ^= ((b << shift) | (b >> (160 - shift))) & _MASK_160
+        res = bytearray(value.to_bytes(20, 'little'))
+        for i, b in enumerate(self.length.to_bytes(8, 'little')):
+            res[12 + i] ^= b
+        return bytes(res)
+
+    def b64digest(self) -> str:
+        return b64encode(self.digest()).decode()
+
+
+def check_hashes(local_path: Path, hashes: dict) -> bool:
+    if 'quickXorHash' in hashes:
+        h, expected = QuickXorHash(), hashes['quickXorHash']
+    elif 'sha256Hash' in hashes:
+        h, expected = hashlib.sha256(), hashes['sha256Hash']
+    elif 'sha1Hash' in hashes:
+        h, expected = hashlib.sha1(), hashes['sha1Hash']
+    else:
+        return True
+    with open(local_path, 'rb') as f:
+        while True:
+            data = f.read(HASH_BLOCK)
+            if not data:
+                break
+            h.update(data)
+    if isinstance(h, QuickXorHash):
+        return h.b64digest() == expected
+    return h.hexdigest().lower() == expected.lower()
+
+
 class ThreadDownload:
 
     def __init__(self,
@@ -56,22 +118,51 @@ class ThreadDownload:
                  url: str,
                  local_path: str,
                  headers: dict = None,
-                 chunk: int = 1310720,
+                 chunk: int = CHUNK_SIZE,
+                 verify=None,
+                 session: requests.Session = None,
                  **kwargs) -> None:
         if size <= 0 or chunk <= 0:
             raise ValueError('invalid params')
+        self.size = size
+        self.chunk = chunk
+        self.state_path = Path(f'{local_path}.ranges')
+        done = self._load_state(local_path)
         self.queue = Queue()
         for i in range(0, size, chunk):
-            self.queue.put((i, i + chunk - 1))
+            if i not in done:
+                self.queue.put((i, min(i + chunk, size) - 1))
         self.error_queue = Queue()
         self.local_path = local_path
         self.url = url
         self.headers = headers
+        self.verify = verify
+        self.session = session or default_transport.session
         self.kwargs = kwargs
         self.lock = Lock()
+        if done:
+            logging.info('resume download %s, %d/%d ranges done', local_path, len(done), -(-size // chunk))
+            return
         with open(local_path, 'wb') as f:
             f.seek(size - 1)
             f.write(b'\x00')
+        with open(self.state_path, 'w') as f:
+            f.write(f'{size} {chunk}\n')
+
+    def _load_state(self, local_path) -> set:
+        try:
+            if Path(local_path).stat().st_size != self.size:
+                return set()
+            with open(self.state_path) as f:
+                if f.readline() != f'{self.size} {self.chunk}\n':
+                    return set()
+                return {
+                    int(line)
+                    for line in f
+                    if line.endswith('\n') and int(line) % self.chunk == 0 and int(line) < self.size
+                }
+        except (OSError, ValueError):
+            return set()
 
     def download(self):
         while True:
@@ -87,22 +178,34 @@ class ThreadDownload:
                 return
 
     def _download(self, content_range, headers):
-        for i in range(0, 5):
-            try:
-                with requests.get(self.url, headers=headers, stream=True, **self.kwargs) as r:
-                    if r.status_code >= 400:
-                        logging.error('download failed, resp:%s', r.text)
+        length = content_range[1] - content_range[0] + 1
+        with tracer.span('download', 'download_range', offset=content_range[0]) as span:
+            for i in range(0, 5):
+                span['retries'] = i
+                try:
+                    with self.session.get(self.url, headers=headers, stream=True, **self.kwargs) as r:
+                        span['status'] = r.status_code
+                        if r.status_code >= 400:
+                            logging.error('download failed, resp:%s', r.text)
+                            continue
+                        written = 0
+                        with open(self.local_path, 'rb+') as f:
+                            f.seek(content_range[0])
+                            for content in r.iter_content(chunk_size=65536):
+                                if not content or written >= length:
+                                    break
+                                f.write(content[:length - written])
+                                written += len(content)
+                    span['bytes'] = written
+                    if written != length:
+                        logging.error('download incomplete, range: %s, size: %d, retry: %d', content_range, written, i + 1)
                         continue
-                    with open(self.local_path, 'rb+') as f:
-                        f.seek(content_range[0])
-                        for content in r.iter_content(chunk_size=8192):
-                            if not content:
-                                break
-                            f.write(content)
-                return
-            except Exception as e:
-                logging.error('download failed, retry: %d, err: %s', i + 1, e)
-        self.error_queue.put('download failed')
+                    with self.lock, open(self.state_path, 'a') as f:
+                        f.write(f'{content_range[0]}\n')
+                    return
+                except Exception as e:
+                    logging.error('download failed, retry: %d, err: %s', i + 1, e)
+            self.error_queue.put('download failed')
 
     def run(self, n: int = 10):
         tasks = [Thread(target=self.download) for _ in range(n)]
@@ -112,3 +215,116 @@ class ThreadDownload:
             t.join()
         if not self.error_queue.empty():
             raise ValueError('download failed')
+        self.state_path.unlink(missing_ok=True)
+        if self.verify and not self.verify(self.local_path):
+            raise ValueError('verify failed')
+
+
+class BufferQueue:
+
+    def __init__(self, max_bytes: int, chunk: int = CHUNK_SIZE):
+        if chunk <= 0 or max_bytes < chunk:
+            raise ValueError('invalid params')
+        self.chunk = chunk
+        self.max_bytes = max_bytes // chunk * chunk
+        self.queued_bytes = 0
+        self._queue = asyncio.Queue()
+        self._pool = asyncio.Queue()
+        for _ in range(max_bytes // chunk):
+            self._pool.put_nowait(bytearray(chunk))
+
+    async def acquire(self) -> bytearray:
+        return await self._pool.get()
+
+    def release(self, data):
+        if isinstance(data, memoryview):
+            buf = data.obj
+            data.release()
+        else:
+            buf = data
+        self._pool.put_nowait(buf)
+
+    async def put(self, item, size: int = 0):
+        self.queued_bytes += size
+        await self._queue.put((item, size))
+
+    async def get(self):
+        item, size = await self._queue.get()
+        self.queued_bytes -= size
+        return item
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+
+class SpillQueue(BufferQueue):
+
+    def __init__(self, max_bytes: int, spill_path: Path, spill_bytes: int, chunk: int = CHUNK_SIZE):
+        if spill_bytes < chunk:
+            raise ValueError('invalid params')
+        super().__init__(max_bytes, chunk)
+        self.spill_path = Path(spill_path)
+        self.spill_bytes = spill_bytes
+        self.spilled_bytes = 0
+        self._spans = deque()
+        with open(self.spill_path, 'wb+') as f:
+            f.truncate(spill_bytes)
+            self._mmap = mmap.mmap(f.fileno(), spill_bytes)
+
+    def _alloc(self, n: int) -> int:
+        if not self._spans:
+            return 0
+        first = self._spans[0][0]
+        end = self._spans[-1][0] + self._spans[-1][1]
+        if end > first:
+            if end + n <= self.spill_bytes:
+                return end
+            if n <= first:
+                return 0
+        elif end + n <= first:
+            return end
+        return -1
+
+    async def put(self, item, size: int = 0):
+        data = item[3] if isinstance(item, tuple) else None
+        if isinstance(data, memoryview) and self._pool.empty():
+            offset = self._alloc(len(data))
+            if offset >= 0:
+                self._mmap[offset:offset + len(data)] = data
+                self._spans.append((offset, len(data)))
+                self.spilled_bytes += len(data)
+                item = item[:3] + (memoryview(self._mmap)[offset:offset + len(data)], ) + item[4:]
+                super().release(data)
+        await super().put(item, size)
+
+    def release(self, data):
+        if isinstance(data, memoryview) and data.obj is self._mmap:
+            data.release()
+            self._spans.popleft()
+            return
+        super().release(data)
+
+    def close(self):
+        while not self._queue.empty():
+            item, _ = self._queue.get_nowait()
+            if isinstance(item, tuple) and isinstance(item[3], memoryview):
+                self.release(item[3])
+        try:
+            self._mmap.close()
+        except BufferError:
+            logging.warning('spill buffer still in use')
+        self.spill_path.unlink(missing_ok=True)
+
+
+async def read_into(content: aiohttp.StreamReader, buf: bytearray) -> memoryview:
+    view = memoryview(buf)
+    n = 0
+    async for data in content.iter_any():
+        if n + len(data) > len(buf):
+            view.release()
+            raise ValueError('response larger than buffer')
+        view[n:n + len(data)] = data
+        n += len(data)
+    res = view[:n]
+    view.release()
+    return res